@@ -0,0 +1,192 @@
+import json
+import pystac
+from botocore.exceptions import ClientError
+
+import publish_mod as pb
+
+#Functions to help shard the static catalog's items into year/month sub-catalogs
+
+def s3_url(bucket_name, key):
+    return f'https://{bucket_name}.s3.amazonaws.com/{key}'
+
+def subcatalog_keys(prefix, item_datetime):
+    """Keys of the year and month sub-catalogs an item with this datetime is linked from."""
+    year_key = f"{prefix}/{item_datetime.strftime('%Y')}/catalog.json"
+    month_key = f"{prefix}/{item_datetime.strftime('%Y/%m')}/catalog.json"
+    return year_key, month_key
+
+def subcatalog(catalog_id, title, description, self_url, parent_url, root_url):
+    """An empty sub-catalog as a dict, linked to its parent and the root catalog."""
+    return {
+        "type": "Catalog",
+        "stac_version": "1.0.0",
+        "id": catalog_id,
+        "title": title,
+        "description": description,
+        "links": [
+            {"rel": "root", "href": root_url, "type": "application/json"},
+            {"rel": "parent", "href": parent_url, "type": "application/json"},
+            {"rel": "self", "href": self_url, "type": "application/json"},
+        ],
+    }
+
+def add_link(catalog_dict, rel, href, title=None):
+    """Add a link to a catalog dict unless it already has it. Returns True if the link was added."""
+    if any(link["rel"] == rel and link["href"] == href for link in catalog_dict["links"]):
+        return False
+    link = {"rel": rel, "href": href, "type": "application/json"}
+    if title is not None:
+        link["title"] = title
+    catalog_dict["links"].append(link)
+    return True
+
+def get_json(s3_client, bucket_name, key):
+    """A json document from the bucket, or None if there isn't one at key."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(pb.read_body(response))
+
+def put_json(s3_client, bucket_name, key, obj):
+    pb.put_document(s3_client, bucket_name, key, json.dumps(obj))
+
+def linked_item_ids(catalog_dict):
+    """Ids of the items a sub-catalog links to, taken from the item json file names."""
+    if catalog_dict is None:
+        return set()
+    return {pb.base_name(link["href"]) for link in catalog_dict["links"] if link["rel"] == "item"}
+
+def child_link(links, title):
+    """The child link with this title (YYYY for years, MM for months), or None."""
+    for link in links:
+        if link["rel"] == "child" and link.get("title") == title:
+            return link
+    return None
+
+def collection_child_links(collection):
+    return [{"rel": "child", "href": link.href, "title": link.title} for link in collection.get_links("child")]
+
+def find_subcatalogs(s3_client, bucket_name, collection, item_datetime):
+    """
+    The year and month sub-catalogs (url, dict) an item with this datetime belongs in, found by following the
+    collection's child links so it works whatever keys the sub-catalogs were published under. (None, None) for
+    any that doesn't exist yet.
+    """
+    year_link = child_link(collection_child_links(collection), item_datetime.strftime('%Y'))
+    if year_link is None:
+        return (None, None), (None, None)
+    year_catalog = get_json(s3_client, bucket_name, pb.s3_key(bucket_name, year_link["href"]))
+    month_link = child_link(year_catalog["links"], item_datetime.strftime('%m')) if year_catalog is not None else None
+    if month_link is None:
+        return (year_link["href"], year_catalog), (None, None)
+    return (year_link["href"], year_catalog), (month_link["href"], get_json(s3_client, bucket_name, pb.s3_key(bucket_name, month_link["href"])))
+
+def _sort_links(catalog_dict, rel):
+    catalog_dict["links"] = ([link for link in catalog_dict["links"] if link["rel"] != rel] +
+                             sorted((link for link in catalog_dict["links"] if link["rel"] == rel), key=lambda link: link.get("title") or link["href"]))
+
+def add_items_to_subcatalogs(s3_client, bucket_name, prefix, collection, collection_url, root_url, items, rebuild=False, publication=None):
+    """
+    Link items into year/month sub-catalogs under a collection, collection -> year -> month -> items.
+
+    Only the month catalogs that get new items are rewritten, along with their year catalog and the collection
+    when they need a new or changed child link, so an update touches a handful of small documents however big
+    the catalog gets.
+
+    Args:
+        s3_client: boto3 s3 client.
+        bucket_name (str): Bucket the catalog is in.
+        prefix (str): Key prefix the sub-catalogs are written under.
+        collection (pystac.Collection): The collection the year catalogs are children of.
+        collection_url (str): URL of the collection document.
+        root_url (str): URL of the root catalog.
+        items (list): (item url, item datetime) of the items to link.
+        rebuild (bool): Start from empty sub-catalogs instead of adding to the ones in the bucket.
+        publication (publish_mod.Publication): Stage the sub-catalogs in this publication under content addressed
+            keys instead of writing them in place. The month catalogs then have no parent link, a year catalog's
+            key depends on its months' so they can't point back up to it.
+
+    Returns:
+        bool: True if the collection's child links changed and it needs writing.
+    """
+    months = {}
+    for item_url, item_datetime in items:
+        months.setdefault(subcatalog_keys(prefix, item_datetime), []).append((item_url, item_datetime))
+
+    def write(key, catalog_dict, old_url, keep_parent=True):
+        if publication is None:
+            put_json(s3_client, bucket_name, key, catalog_dict)
+            return s3_url(bucket_name, key)
+        if old_url is not None:
+            publication.replace(old_url)
+        if not keep_parent:
+            catalog_dict["links"] = [link for link in catalog_dict["links"] if link["rel"] != "parent"]
+        return publication.add(catalog_dict, key)
+
+    # year key -> (datetime, year url, year catalog, {month title: new month url})
+    years = {}
+    for (year_key, month_key), month_items in sorted(months.items()):
+        month_datetime = month_items[0][1]
+        if rebuild:
+            (year_url, year_catalog), (month_url, month_catalog) = (None, None), (None, None)
+        else:
+            (year_url, year_catalog), (month_url, month_catalog) = find_subcatalogs(s3_client, bucket_name, collection, month_datetime)
+        if month_catalog is None:
+            month_url = None
+            month_catalog = subcatalog(f"{collection.id}-{month_datetime.strftime('%Y-%m')}", month_datetime.strftime('%Y-%m'),
+                                       f"{collection.title or collection.id} items from {month_datetime.strftime('%B %Y')}",
+                                       s3_url(bucket_name, month_key), s3_url(bucket_name, year_key), root_url)
+
+        # add the item links in time order so the leaf reads like a listing, a reprocessed item replaces its old link
+        changed = False
+        for item_url, _ in sorted(month_items, key=lambda i: (i[1], i[0])):
+            item_id = pb.base_name(item_url)
+            old = [link for link in month_catalog["links"] if link["rel"] == "item" and pb.base_name(link["href"]) == item_id]
+            if old and old[0]["href"] == item_url:
+                continue
+            for link in old:
+                month_catalog["links"].remove(link)
+                if publication is not None:
+                    publication.replace(link["href"])
+            add_link(month_catalog, "item", item_url)
+            changed = True
+        if not changed:
+            continue
+
+        new_month_url = write(month_key, month_catalog, month_url, keep_parent=False)
+        year = years.setdefault(year_key, [month_datetime, year_url, year_catalog, {}])
+        if new_month_url != month_url:
+            year[3][month_datetime.strftime('%m')] = new_month_url
+
+    collection_changed = False
+    for year_key, (year_datetime, year_url, year_catalog, month_urls) in sorted(years.items()):
+        if not month_urls:
+            continue
+        if year_catalog is None:
+            year_url = None
+            year_catalog = subcatalog(f"{collection.id}-{year_datetime.strftime('%Y')}", year_datetime.strftime('%Y'),
+                                      f"{collection.title or collection.id} items from {year_datetime.strftime('%Y')}",
+                                      s3_url(bucket_name, year_key), collection_url, root_url)
+        for month_title, month_url in month_urls.items():
+            link = child_link(year_catalog["links"], month_title)
+            if link is not None:
+                link["href"] = month_url
+            else:
+                add_link(year_catalog, "child", month_url, title=month_title)
+        _sort_links(year_catalog, "child")
+        new_year_url = write(year_key, year_catalog, year_url)
+
+        if new_year_url != year_url:
+            year_title = year_datetime.strftime('%Y')
+            for link in collection.get_links("child"):
+                if link.title == year_title:
+                    link.target = new_year_url
+                    break
+            else:
+                collection.add_link(pystac.Link(rel="child", target=new_year_url, media_type="application/json", title=year_title))
+            collection_changed = True
+
+    return collection_changed
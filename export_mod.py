@@ -0,0 +1,209 @@
+import os
+import gzip
+import calendar
+import tempfile
+import orjson
+from botocore.exceptions import ClientError
+
+import publish_mod as pb
+
+#Functions to help export the catalog's items in bulk formats
+
+def item_partition(item_dict):
+    """year=YYYY/month=MM partition an item belongs in, from its datetime (or start_datetime)."""
+    properties = item_dict["properties"]
+    item_datetime = properties.get("datetime") or properties["start_datetime"]
+    return f"year={item_datetime[:4]}/month={item_datetime[5:7]}"
+
+def stage_path(stage_dir, partition):
+    """Local NDJSON file the items of a partition are staged in."""
+    return os.path.join(stage_dir, partition, "items.ndjson")
+
+def stage_item(stage_dir, partition, item_json):
+    """Append an item's json bytes to its partition's staging file."""
+    path = stage_path(stage_dir, partition)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as f:
+        f.write(item_json + b"\n")
+
+def read_staged_items(path):
+    """Items in a staging file, an item staged more than once (reprocessed) keeps only its latest version."""
+    items = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                item_dict = orjson.loads(line)
+                items[item_dict["id"]] = item_dict
+    return list(items.values())
+
+def require_geoparquet():
+    """Raise ImportError up front if the geoparquet export's optional dependencies aren't installed."""
+    try:
+        import pyarrow.parquet
+        import stac_geoparquet.arrow
+    except ImportError as e:
+        raise ImportError(f"The geoparquet export needs stac-geoparquet and pyarrow, pip install stac-geoparquet into the venv: {e}") from e
+
+def write_geoparquet(items, out_path):
+    """
+    Write items to a stac-geoparquet file, sorted by datetime so row group statistics prune temporal scans.
+
+    The file is written next to out_path and moved into place, so readers never see a partial file.
+    """
+    # only the export needs stac-geoparquet and pyarrow
+    from stac_geoparquet.arrow import parse_stac_items_to_arrow, to_parquet
+
+    items = sorted(items, key=lambda item: (item["properties"].get("datetime") or item["properties"]["start_datetime"], item["id"]))
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path), suffix='.parquet.tmp')
+    os.close(fd)
+    try:
+        to_parquet(parse_stac_items_to_arrow(items), tmp_path)
+        os.replace(tmp_path, out_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return out_path
+
+def read_geoparquet(path):
+    """Items stored in a stac-geoparquet file, as dicts."""
+    import pyarrow.parquet as pq
+    from stac_geoparquet.arrow import stac_table_to_items
+
+    return list(stac_table_to_items(pq.read_table(path)))
+
+def seed_stage(s3_client, bucket, key, stage_dir, partition):
+    """
+    Make sure a partition's staging file holds the items already exported for it before new items are staged.
+
+    A staging file that's missing (first run on this machine, or it was cleaned up) is rebuilt from the
+    partition's geoparquet file on s3 if there is one, so rewriting the partition never drops old items.
+
+    Returns:
+        int: Number of items the staging file was seeded with.
+    """
+    path = stage_path(stage_dir, partition)
+    if os.path.exists(path):
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = os.path.join(tmp_dir, "items.parquet")
+        try:
+            s3_client.download_file(bucket, key, parquet_path)
+        except ClientError:
+            # nothing exported for this partition yet
+            return 0
+        items = read_geoparquet(parquet_path)
+    with open(path, 'wb') as f:
+        for item_dict in items:
+            f.write(orjson.dumps(item_dict) + b"\n")
+    return len(items)
+
+def export_geoparquet_partition(stage_dir, partition, out_dir):
+    """
+    Rewrite one partition's geoparquet file from its staging file.
+
+    Returns:
+        tuple: (path of the geoparquet file, number of items in it).
+    """
+    items = read_staged_items(stage_path(stage_dir, partition))
+    out_path = os.path.join(out_dir, partition, "items.parquet")
+    write_geoparquet(items, out_path)
+    return out_path, len(items)
+
+def gzip_ndjson(item_jsons):
+    """Compress item json bytes into one gzip member of NDJSON. Gzip members can be concatenated into a valid gzip file."""
+    return gzip.compress(b"".join(item_json + b"\n" for item_json in item_jsons), mtime=0)
+
+def _get_object(s3_client, bucket, key):
+    """Body and user metadata of an s3 object, or (None, {}) if it doesn't exist."""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, {}
+        raise
+    return response["Body"].read(), response.get("Metadata", {})
+
+def _object_exists(s3_client, bucket, key):
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return False
+        raise
+    return True
+
+def month_days(day):
+    """Every YYYY-MM-DD day of the month a YYYY-MM-DD day is in."""
+    year, month = int(day[:4]), int(day[5:7])
+    return [f"{day[:7]}-{d:02d}" for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+
+def _put_rollup(s3_client, bucket, key, body, metadata=None):
+    # a put replaces the whole object at once so readers get either the old or the new rollup, never a partial one.
+    # The rollup is a .gz file, not gzip encoded NDJSON, so clients download it as is instead of decoding it on the fly
+    s3_client.put_object(Body=body, Bucket=bucket, Key=key, ContentType='application/gzip',
+                         CacheControl=pb.cache_control["document"], Metadata=metadata or {})
+
+def update_day_rollup(s3_client, bucket, key, items):
+    """
+    Merge a day's items into its gzipped NDJSON rollup on s3.
+
+    Items already in the rollup (from an earlier run over the same day) are kept unless they were rebuilt.
+
+    Args:
+        items (list): (item id, item json bytes) pairs.
+
+    Returns:
+        bytes: The day's rollup, a single gzip member.
+    """
+    merged = {}
+    existing, _ = _get_object(s3_client, bucket, key)
+    if existing is not None:
+        for line in gzip.decompress(existing).splitlines():
+            if line.strip():
+                merged[orjson.loads(line)["id"]] = line
+    for item_id, item_json in items:
+        merged[item_id] = item_json
+    body = gzip_ndjson(merged.values())
+    _put_rollup(s3_client, bucket, key, body)
+    return body
+
+def update_month_rollup(s3_client, bucket, key, day, day_body, day_key):
+    """
+    Add a day's rollup to its month's rollup on s3.
+
+    The month rollup is the day rollups' gzip members concatenated in day order, the days it holds are kept
+    in the object's metadata. A day after all the ones already there is appended without recompressing anything,
+    a day that's already there or out of order has the month rebuilt from the day rollups. So does a month
+    without the days metadata (written before it was kept, or by another writer), from the day rollups there are for it.
+
+    Args:
+        day (str): The day, YYYY-MM-DD.
+        day_body (bytes): The day's rollup, from update_day_rollup.
+        day_key (function): Returns the key of the rollup for a YYYY-MM-DD day.
+    """
+    existing, metadata = _get_object(s3_client, bucket, key)
+    days = metadata["days"].split(",") if metadata.get("days") else None
+    if existing is None:
+        body = day_body
+        days = [day]
+    elif days is not None and all(existing_day < day for existing_day in days):
+        body = existing + day_body
+        days.append(day)
+    else:
+        if days is None:
+            # which days the month holds isn't recorded, take every day that has a rollup
+            days = [month_day for month_day in month_days(day) if month_day != day and _object_exists(s3_client, bucket, day_key(month_day))]
+        days = sorted(set(days) | {day})
+        members = []
+        for member_day in days:
+            if member_day == day:
+                members.append(day_body)
+            else:
+                member, _ = _get_object(s3_client, bucket, day_key(member_day))
+                if member is not None:
+                    members.append(member)
+        body = b"".join(members)
+    _put_rollup(s3_client, bucket, key, body, {"days": ",".join(days)})
+    return len(days)
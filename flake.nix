@@ -29,6 +29,8 @@
 		numba
 		rasterio
 		shapely
+		fiona
+		pyarrow
 		pip
 		  ]))
         ];
@@ -0,0 +1,293 @@
+import os
+import re
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import jsonschema
+import orjson
+from pystac.errors import STACValidationError
+from pystac.extensions.item_assets import ItemAssetsExtension, AssetDefinition
+from pystac.validation import JsonSchemaSTACValidator, set_validator, validate_dict
+
+#Functions to help build, validate and serialize the stac items
+
+def dumps(obj):
+    """Serialize a STAC dict straight to json bytes. numpy values are serialized as is."""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+# per item fields, a template setting any of these would be overwritten by every item
+item_dynamic_fields = ("id", "geometry", "bbox", "links")
+
+def load_item_template(template_path):
+    """
+    Load a collection's item template, the fields every item in the collection has in common.
+
+    The template is a partial item json (type, stac_version, stac_extensions, collection, static properties
+    and asset definitions). It's loaded once per run and each item is rendered from it with render_item.
+    """
+    with open(template_path) as f:
+        template = json.load(f)
+    for key in item_dynamic_fields:
+        if key in template:
+            raise ValueError(f"Item template {template_path} sets {key}, which is different for every item")
+    return template
+
+def set_item_assets(collection, template):
+    """
+    Publish the template's asset definitions as the collection's item_assets.
+
+    Items rendered from the template carry exactly these asset titles, media types and roles, so pgstac
+    dehydrates them out of every stored item and adds them back when the item is read.
+
+    Returns:
+        bool: True if the collection's item_assets changed and it needs loading again.
+    """
+    item_assets = {key: dict(asset) for key, asset in template.get("assets", {}).items()}
+    if ItemAssetsExtension.has_extension(collection) and collection.extra_fields.get("item_assets") == item_assets:
+        return False
+    ItemAssetsExtension.ext(collection, add_if_missing=True).item_assets = {key: AssetDefinition(asset) for key, asset in item_assets.items()}
+    return True
+
+def _merge(base, fields):
+    """Merge fields over base, dicts are merged recursively and only copied along the paths fields touch."""
+    merged = dict(base)
+    for key, value in fields.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def render_item(template, fields):
+    """
+    Build an item dict from the static item template and the fields that differ per item.
+
+    The template's assets are definitions (title, type, roles...), only the assets the item gives fields
+    for (at least an href) end up in the item. No pystac objects are built along the way.
+    """
+    fields = dict(fields)
+    asset_fields = fields.pop("assets", {})
+    item = _merge(template, fields)
+    template_assets = template.get("assets", {})
+    item["assets"] = {key: _merge(template_assets.get(key, {}), asset) for key, asset in asset_fields.items()}
+    return item
+
+def item_links(item_href, collection_href, collection_title=None):
+    """The root, collection, parent and self links of an item in a collection that is its own root."""
+    collection_link = {"href": collection_href, "type": "application/json"}
+    if collection_title is not None:
+        collection_link["title"] = collection_title
+    return [
+        {"rel": "root", **collection_link},
+        {"rel": "collection", **collection_link},
+        {"rel": "parent", **collection_link},
+        {"rel": "self", "href": item_href, "type": "application/json"},
+    ]
+
+def schema_filename(schema_uri):
+    """File name a schema is stored under in the local schema directory."""
+    return re.sub(r'[^A-Za-z0-9._-]', '_', schema_uri.split('://', 1)[-1])
+
+class LocalSchemaValidator(JsonSchemaSTACValidator):
+    """
+    pystac validator that reads the STAC JSON schemas from a local directory and compiles each one only once.
+
+    pystac's own validator only ships the core schemas, so extension schemas get fetched over the network
+    in every new process, and it rebuilds the reference registry and validator on every call. Here any schema
+    missing from the directory is fetched once and written into it, so validation works offline from then on.
+    """
+
+    def __init__(self, schema_dir):
+        super().__init__()
+        self.schema_dir = schema_dir
+        os.makedirs(schema_dir, exist_ok=True)
+        for name in sorted(os.listdir(schema_dir)):
+            if name.endswith('.json'):
+                with open(os.path.join(schema_dir, name)) as f:
+                    schema = json.load(f)
+                self.schema_cache[schema.get("$id", schema.get("id"))] = schema
+        self._registry = None
+        self._validators = {}
+
+    def _get_schema(self, schema_uri):
+        if schema_uri not in self.schema_cache:
+            schema = super()._get_schema(schema_uri)
+            with open(os.path.join(self.schema_dir, schema_filename(schema_uri)), 'w') as f:
+                json.dump(schema, f)
+        return self.schema_cache[schema_uri]
+
+    @property
+    def registry(self):
+        # built once, schemas referenced later are still pulled in through _get_schema
+        if self._registry is None:
+            self._registry = super().registry
+        return self._registry
+
+    def _validate_from_uri(self, stac_dict, stac_object_type, schema_uri, href=None):
+        validator = self._validators.get(schema_uri)
+        if validator is None:
+            schema = self._get_schema(schema_uri)
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            validator = cls(schema, registry=self.registry)
+            self._validators[schema_uri] = validator
+
+        errors = list(validator.iter_errors(stac_dict))
+        if errors:
+            # same message pystac's validator builds
+            stac_id = stac_dict.get("id", None)
+            msg = f"Validation failed for {stac_object_type} "
+            if href is not None:
+                msg += f"at {href} "
+            if stac_id is not None:
+                msg += f"with ID {stac_id} "
+            msg += f"against schema at {schema_uri}"
+
+            best = jsonschema.exceptions.best_match(errors)
+            if best:
+                msg += "\n" + str(best)
+            raise STACValidationError(msg, source=errors) from best
+
+def use_local_schemas(schema_dir, schema_uris=()):
+    """
+    Make pystac validate against the schemas in schema_dir for the rest of the process.
+
+    Any of schema_uris not in the directory yet are fetched and saved up front, so nothing is fetched mid run.
+    One that can't be fetched (e.g. no network) is left to be fetched when it's first validated against.
+    """
+    validator = LocalSchemaValidator(schema_dir)
+    for schema_uri in schema_uris:
+        try:
+            validator._get_schema(schema_uri)
+        except Exception as e:
+            print(f"Warning: couldn't prefetch schema {schema_uri}, it will be fetched when first needed: {e}")
+    set_validator(validator)
+    return validator
+
+# how much schema validation items get
+#   always: every item is validated against its schemas inline
+#   sample: 1 in sample_every items is validated, the rest get the structural check
+#   structural: only the structural check
+#   deferred: the structural check inline, full validation in background processes over a spool of the items
+validation_policies = ("always", "sample", "structural", "deferred")
+
+def structural_errors(item_dict):
+    """Cheap checks that an item dict has the shape of a STAC item, without touching any schema."""
+    errors = []
+    for key in ("type", "stac_version", "id", "geometry", "bbox", "properties", "links", "assets"):
+        if key not in item_dict:
+            errors.append(f"missing {key}")
+    if item_dict.get("type") != "Feature":
+        errors.append("type is not Feature")
+    bbox = item_dict.get("bbox")
+    if bbox is not None and len(bbox) not in (4, 6):
+        errors.append("bbox does not have 4 or 6 values")
+    properties = item_dict.get("properties", {})
+    if properties.get("datetime") is None and not (properties.get("start_datetime") and properties.get("end_datetime")):
+        errors.append("datetime is null without start_datetime and end_datetime")
+    for key, asset in item_dict.get("assets", {}).items():
+        if not asset.get("href"):
+            errors.append(f"asset {key} has no href")
+    return errors
+
+def _init_validation_worker(schema_dir):
+    """Set up the local schema validator in each background validation process."""
+    if schema_dir is not None:
+        use_local_schemas(schema_dir)
+
+def _validate_spool(spool_path):
+    """Fully validate every item in an NDJSON spool, returning the failures. The spool is removed afterwards."""
+    failures = []
+    with open(spool_path) as f:
+        for line in f:
+            item_dict = orjson.loads(line)
+            try:
+                validate_dict(item_dict)
+            except Exception as e:
+                failures.append({"id": item_dict.get("id"), "policy": "deferred", "error": str(e)})
+    os.remove(spool_path)
+    return failures
+
+class ItemValidator:
+    """
+    Validates items according to a validation policy and writes failures to an NDJSON report file.
+
+    Args:
+        policy (str): One of validation_policies.
+        report_path (str): File failures are appended to, one json object per line.
+        sample_every (int): With the sample policy, validate 1 in this many items.
+        schema_dir (str): Local schema directory the deferred validation processes use.
+        spool_dir (str): Where deferred items are spooled before validation.
+        batch_size (int): Items per spool file handed to a background process.
+        max_workers (int): Number of background validation processes.
+    """
+
+    def __init__(self, policy="always", report_path="validation-report.ndjson", sample_every=100,
+                 schema_dir=None, spool_dir="validation-spool", batch_size=1000, max_workers=2):
+        if policy not in validation_policies:
+            raise ValueError(f"Unknown validation policy {policy}, use one of {validation_policies}")
+        self.policy = policy
+        self.report_path = report_path
+        self.sample_every = sample_every
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.count = 0
+        self.failures = 0
+        self._spool_file = None
+        self._spooled = 0
+        self._futures = []
+        self._executor = None
+        if policy == "deferred":
+            os.makedirs(spool_dir, exist_ok=True)
+            # spawned rather than forked so the workers don't inherit the callers open connections and threads
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_validation_worker, initargs=(schema_dir,))
+
+    def _report(self, failures):
+        if not failures:
+            return
+        self.failures += len(failures)
+        with open(self.report_path, 'a') as f:
+            for failure in failures:
+                f.write(json.dumps(failure) + "\n")
+
+    def _submit_spool(self):
+        self._spool_file.close()
+        self._futures.append(self._executor.submit(_validate_spool, self._spool_file.name))
+        self._spool_file = None
+        self._spooled = 0
+
+    def check(self, item_dict, item_json=None):
+        """Validate an item dict as the policy says. item_json is the item already serialized to bytes, if it has been."""
+        self.count += 1
+        full = self.policy == "always" or (self.policy == "sample" and (self.count - 1) % self.sample_every == 0)
+        if full:
+            try:
+                validate_dict(item_dict)
+            except Exception as e:
+                self._report([{"id": item_dict.get("id"), "policy": self.policy, "error": str(e)}])
+            return
+
+        errors = structural_errors(item_dict)
+        if errors:
+            self._report([{"id": item_dict.get("id"), "policy": "structural", "error": "; ".join(errors)}])
+
+        if self.policy == "deferred":
+            if self._spool_file is None:
+                self._spool_file = open(os.path.join(self.spool_dir, f"items-{os.getpid()}-{len(self._futures)}.ndjson"), 'wb')
+            self._spool_file.write((item_json if item_json is not None else dumps(item_dict)) + b"\n")
+            self._spooled += 1
+            if self._spooled >= self.batch_size:
+                self._submit_spool()
+
+    def close(self):
+        """Wait for any deferred validation to finish and report its failures. Returns the total number of failures."""
+        if self._executor is not None:
+            if self._spool_file is not None:
+                self._submit_spool()
+            for future in self._futures:
+                self._report(future.result())
+            self._futures = []
+            self._executor.shutdown()
+            self._executor = None
+        return self.failures
@@ -19,6 +19,8 @@ from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 
 import stac_mod as sm
+import catalog_mod as cm
+import publish_mod as pb
 
 ########### Initialize catalog and collection
 # date from which data for the collection begins
@@ -65,28 +67,47 @@ catalog_object_key = 'catalog.json'
 # Key for the collection object in the S3 bucket, within the "collections" folder
 collection_object_key = 'collections/viirs-1-day.json'
 
+# Prefix of the year/month sub-catalogs the collection's items are sharded into
+subcatalog_prefix = 'catalogs/viirs-1-day'
+
+# Where updatecatalog.py keeps its publish manifests, they record which item versions have been superseded
+version_prefix = 'versions/viirs-1-day'
+
 # Set the collection's self_href to the S3 URL
 collection.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{collection_object_key}')
 
-# List all the item JSON files from the S3 bucket's "items" folder
-response = s3.list_objects_v2(Bucket=bucket_name, Prefix='items/')
-
-# Check if the response contains 'Contents' key
-if 'Contents' in response:
-    for content in response['Contents']:
+# The items folder can hold several versions of an item (ID.json from before publishes were content addressed,
+# then an ID.<digest>.json per publish that changed it). Leave out the ones a publish superseded and take the newest of the rest
+superseded = pb.superseded_keys(s3, bucket_name, version_prefix)
+current_keys = {}
+paginator = s3.get_paginator('list_objects_v2')
+for page in paginator.paginate(Bucket=bucket_name, Prefix='items/'):
+    for content in page.get('Contents', []):
         object_key = content['Key']
-        
-        # Download the item JSON
-        item_data = s3.get_object(Bucket=bucket_name, Key=object_key)
-        item_content = item_data['Body'].read().decode('utf-8')
-        
-        # Parse the JSON content into a pystac.Item object
-        item_dict = json.loads(item_content)
-        item = pystac.Item.from_dict(item_dict)
-        
-        # Add the item to the collection
-        collection.add_item(item)
-        item.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{object_key}')
+        # the items folder also holds rollups and tile indexes
+        if not object_key.endswith('.json') or object_key in superseded:
+            continue
+        item_id = pb.base_name(object_key)
+        if item_id not in current_keys or content['LastModified'] > current_keys[item_id][1]:
+            current_keys[item_id] = (object_key, content['LastModified'])
+
+# List all the current item JSON files
+items = []
+for object_key, _ in current_keys.values():
+    # Download the item JSON
+    item_data = s3.get_object(Bucket=bucket_name, Key=object_key)
+    item_dict = json.loads(pb.read_body(item_data))
+    if item_dict.get("type") != "Feature":
+        continue
+
+    properties = item_dict["properties"]
+    item_datetime = pystac.utils.str_to_datetime(properties.get("datetime") or properties["start_datetime"])
+    items.append((f'https://{bucket_name}.s3.amazonaws.com/{object_key}', item_datetime))
+
+# link the items from year/month sub-catalogs instead of straight from the collection, so no one document lists every item
+cm.add_items_to_subcatalogs(s3, bucket_name, subcatalog_prefix, collection,
+                            f'https://{bucket_name}.s3.amazonaws.com/{collection_object_key}',
+                            f'https://{bucket_name}.s3.amazonaws.com/{catalog_object_key}', items, rebuild=True)
 
 ###### write catalog and collection. Be aware that messing with the sequencing of relationship assignments here or above might break catalog creation code!!! So have a commit to come back to.
 
@@ -109,12 +130,12 @@ catalog.add_link(catalog_child)
 catalog_json = json.dumps(catalog.to_dict())
 
 # Write the catalog JSON string to the S3 bucket
-s3.put_object(Body=catalog_json, Bucket=bucket_name, Key=catalog_object_key, ContentType='application/json')
+pb.put_document(s3, bucket_name, catalog_object_key, catalog_json, cache="root")
 
 # Convert the collection to a JSON string
 collection_json = json.dumps(collection.to_dict())
 
 # Write the collection JSON string to the S3 bucket
-s3.put_object(Body=collection_json, Bucket=bucket_name, Key=collection_object_key, ContentType='application/json')
+pb.put_document(s3, bucket_name, collection_object_key, collection_json, cache="root")
 
 
@@ -0,0 +1,183 @@
+import os
+import atexit
+from datetime import date, datetime, timezone
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
+from pypgstac.db import PgstacDB
+from pypgstac.load import Loader, Methods
+
+#Functions to help set up and load the pgstac database
+
+def create_pool(dsn="", min_size=1, max_size=4, timeout=60):
+    """
+    Open a pool of connections to pgstac that the pipeline and any concurrent workers share.
+
+    Workers wait up to timeout seconds for a free connection rather than opening new ones,
+    so max_size caps how many connections the pipeline ever holds on the server.
+    The connection settings come from the usual PG* environment variables when dsn is empty.
+    """
+    return ConnectionPool(conninfo=dsn, min_size=min_size, max_size=max_size, timeout=timeout, open=True)
+
+class PooledPgstacDB(PgstacDB):
+    """
+    PgstacDB that can borrow a connection from a shared pool any number of times.
+
+    PgstacDB drops its pool when it hands its connection back, so it only lasts for one borrow. This one keeps
+    the pool, so a single Loader (and its collection, partition and version caches) lasts the whole run while
+    each with block only holds a connection for as long as it runs.
+    """
+
+    def disconnect(self):
+        pool = self.pool
+        super().disconnect()
+        # connect registers disconnect to run at exit on every borrow
+        atexit.unregister(self.disconnect)
+        self.pool = pool
+
+def pooled_loader(pool, debug=False):
+    """
+    A pypgstac Loader on a connection pool, create one per run and reuse it.
+
+    Wrap each database step in "with loader.db:" to borrow a connection for it. Calls that only hit the
+    Loader's caches, like dehydrating items for the spool once their collection has been looked up, need no borrow.
+    """
+    return Loader(PooledPgstacDB(pool=pool, debug=debug))
+
+def existing_item_ids(db, collection_id, item_ids):
+    """Return which of item_ids are already loaded in a collection."""
+    conn = db.connect()
+    # prepared once per connection, pooled connections keep it between calls
+    rows = conn.execute(
+        "SELECT id FROM items WHERE collection = %s AND id = ANY(%s);",
+        (collection_id, list(item_ids)),
+        prepare=True,
+    ).fetchall()
+    return {row[0] for row in rows}
+
+# pgstac functions that cast a property out of the item json for each json schema type, indexes are built on these
+property_wrappers = {"number": "to_float", "integer": "to_int", "string": "to_text"}
+
+def provision_queryables(db, collection_id, queryables):
+    """
+    Register queryables for a collection in pgstac and build indexes for the ones that are filtered on.
+
+    Args:
+        db (PgstacDB): Database to provision.
+        collection_id (str): Collection the queryables apply to.
+        queryables (dict): Property name -> (json schema definition, whether to index it). Date-time
+            strings are wrapped with to_tstz so they compare as timestamps.
+    """
+    conn = db.connect()
+    with conn.cursor() as cur, conn.transaction():
+        for name, (definition, index) in queryables.items():
+            if definition.get("format") == "date-time":
+                wrapper = "to_tstz"
+            else:
+                wrapper = property_wrappers.get(definition.get("type"), "to_text")
+            index_type = "BTREE" if index else None
+
+            # pgstac only allows one queryable per name and collection, so update it if it's already there
+            cur.execute(
+                """
+                UPDATE queryables
+                SET definition = %s, property_wrapper = %s, property_index_type = %s
+                WHERE name = %s AND collection_ids = %s::text[];
+                """,
+                (Jsonb(definition), wrapper, index_type, name, [collection_id]),
+            )
+            if cur.rowcount == 0:
+                cur.execute(
+                    """
+                    INSERT INTO queryables (name, collection_ids, definition, property_wrapper, property_index_type)
+                    VALUES (%s, %s::text[], %s, %s, %s);
+                    """,
+                    (name, [collection_id], Jsonb(definition), wrapper, index_type),
+                )
+
+        # the queryables trigger builds the property indexes on every partition, or queues them when
+        # pgstac.use_queue is on. Run anything queued now so filtered searches use the indexes right away.
+        cur.execute("SELECT run_queued_queries_intransaction();")
+
+def partition_ranges(partition_trunc, start_date, end_date):
+    """Yield the [start, end) datetimes of every year or month partition from start_date through end_date."""
+    if partition_trunc not in ("year", "month"):
+        raise ValueError(f"partition_trunc must be 'year' or 'month', got {partition_trunc}")
+    if partition_trunc == "year":
+        period_start = date(start_date.year, 1, 1)
+    else:
+        period_start = date(start_date.year, start_date.month, 1)
+    while period_start <= end_date:
+        if partition_trunc == "year":
+            period_end = date(period_start.year + 1, 1, 1)
+        elif period_start.month == 12:
+            period_end = date(period_start.year + 1, 1, 1)
+        else:
+            period_end = date(period_start.year, period_start.month + 1, 1)
+        yield (datetime.combine(period_start, datetime.min.time()).replace(tzinfo=timezone.utc),
+               datetime.combine(period_end, datetime.min.time()).replace(tzinfo=timezone.utc))
+        period_start = period_end
+
+def configure_partitions(db, collection_id, partition_trunc, start_date, end_date):
+    """
+    Set how pgstac partitions a collection's items by time and create the partitions for a date range up front.
+
+    With the partitions already there, loading a backfill never stops to create or re-constrain a partition
+    and temporal searches only scan the partitions their range falls in.
+
+    Args:
+        db (PgstacDB): Database the collection is in.
+        collection_id (str): Collection to partition, it must already be loaded.
+        partition_trunc (str): 'year' or 'month'.
+        start_date (date): First day the collection has items for.
+        end_date (date): Last day to create a partition for.
+    """
+    conn = db.connect()
+    with conn.cursor() as cur, conn.transaction():
+        # changing partition_trunc makes pgstac repartition any items already loaded, so only set it when it differs
+        cur.execute(
+            "UPDATE collections SET partition_trunc = %s WHERE id = %s AND partition_trunc IS DISTINCT FROM %s;",
+            (partition_trunc, collection_id, partition_trunc),
+        )
+        for period_start, period_end in partition_ranges(partition_trunc, start_date, end_date):
+            # constrain each partition to its whole period so loading items into it never has to widen the constraints
+            cur.execute(
+                "SELECT check_partition(%s, tstzrange(%s, %s, '[)'), tstzrange(%s, %s, '[]'));",
+                (collection_id, period_start, period_end, period_start, period_end),
+            )
+
+def spool_item(loader, item_dict, spool_path):
+    """
+    Dehydrate an item against its collection's base item and append it to a local spool file.
+
+    The spool is in pgstac's dehydrated format (id, geometry, collection, datetime, end_datetime and the
+    item content, tab separated, one item per line) so it can be copied straight into the items table.
+    The base item is looked up once per collection and cached by the loader, so the spool doesn't cost a
+    database round trip per item.
+    """
+    row = loader.format_item(item_dict)
+    with open(spool_path, 'a') as f:
+        f.write("\t".join([row["id"], row["geometry"], row["collection"], row["datetime"], row["end_datetime"], row["content"]]) + "\n")
+
+def spool_size(spool_path):
+    """Number of items waiting in a spool file."""
+    if not os.path.exists(spool_path):
+        return 0
+    with open(spool_path) as f:
+        return sum(1 for _ in f)
+
+def load_spool(loader, spool_path):
+    """
+    Bulk load a spool file into pgstac then empty it.
+
+    pypgstac groups the items by partition and COPYs each group in one transaction. Items already in the
+    database are skipped (insert_ignore) so a spool left over from a crashed run can safely be loaded again.
+
+    Returns:
+        int: Number of items in the spool.
+    """
+    n_items = spool_size(spool_path)
+    if n_items == 0:
+        return 0
+    loader.load_items(file=spool_path, insert_mode=Methods.insert_ignore, dehydrated=True)
+    open(spool_path, 'w').close()
+    return n_items
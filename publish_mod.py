@@ -0,0 +1,193 @@
+import re
+import gzip
+import json
+import hashlib
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+#Functions to help publish static catalog updates to s3 atomically, with the caching and encoding browsers and CDNs need
+
+# Cache-Control of each kind of object published to the bucket
+cache_control = {
+    # content addressed, what's under the key never changes
+    "immutable": "public, max-age=31536000, immutable",
+    # thumbnails, COGs, tiles and exports, only rewritten when a day is reprocessed
+    "asset": "public, max-age=86400",
+    # items, sub-catalogs and other json at fixed keys
+    "document": "public, max-age=3600",
+    # the catalog and collection roots, they change every run
+    "root": "public, max-age=60, must-revalidate",
+}
+
+# json documents are uploaded as is unless the caller opts into a Content-Encoding ("gzip" or "br", which needs the
+# brotli package) for that kind of document. S3 serves the encoded bytes to every client whatever it accepts: browsers
+# and requests decode them, but boto3, s3:// readers and urllib (pystac's default StacIO) hand back the raw bytes,
+# so the catalog roots, sub-catalogs and tile indexes those clients read are never compressed
+
+def encode_body(body, encoding=None):
+    """Compress a document for upload. Returns the bytes and their Content-Encoding (None if not compressed)."""
+    if isinstance(body, str):
+        body = body.encode()
+    if encoding == "br":
+        try:
+            import brotli
+        except ImportError:
+            encoding = "gzip"
+        else:
+            return brotli.compress(body), "br"
+    if encoding == "gzip":
+        return gzip.compress(body, mtime=0), "gzip"
+    return body, None
+
+def read_body(response):
+    """Body of an s3 get_object response, decoded from its Content-Encoding. boto3 doesn't decode it."""
+    body = response['Body'].read()
+    encoding = response.get('ContentEncoding')
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(body)
+    return body
+
+def put_document(s3_client, bucket_name, key, body, cache="document", content_type='application/json', encoding=None):
+    """Put a json document to the bucket with the Cache-Control of its kind, compressed if an encoding is given."""
+    body, content_encoding = encode_body(body, encoding)
+    args = {"Body": body, "Bucket": bucket_name, "Key": key, "ContentType": content_type, "CacheControl": cache_control[cache]}
+    if content_encoding is not None:
+        args["ContentEncoding"] = content_encoding
+    s3_client.put_object(**args)
+
+def upload_args(content_type, cache="asset"):
+    """ExtraArgs for uploading a file with its media type and the Cache-Control of its kind."""
+    return {"ContentType": content_type, "CacheControl": cache_control[cache]}
+
+def s3_key(bucket_name, url):
+    """Key of an object in the bucket from its https url, None if the url isn't in the bucket."""
+    prefix = f'https://{bucket_name}.s3.amazonaws.com/'
+    return url[len(prefix):] if url.startswith(prefix) else None
+
+def content_digest(doc):
+    """Digest of a STAC document's content. The self link is left out, it's derived from the digest."""
+    links = [link for link in doc.get("links", []) if link.get("rel") != "self"]
+    canonical = json.dumps({**doc, "links": links}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+def content_key(key, digest):
+    """items/x.json -> items/x.<digest>.json"""
+    return f"{key[:-len('.json')]}.{digest}.json"
+
+# matches the digest content_key puts into a file name
+digest_suffix = re.compile(r"\.[0-9a-f]{16}$")
+
+def base_name(url):
+    """File name of a document without .json and any content digest, e.g. the item id of an item url."""
+    return digest_suffix.sub("", url.split("/")[-1][:-len(".json")])
+
+class Publication:
+    """
+    One catalog update, published so readers always see either the old or the new catalog.
+
+    New and changed documents are added under content addressed keys (their digest in the file name) that
+    nothing references yet, so writing them changes nothing readers can see. commit uploads them all in parallel
+    and only then writes the root document at its fixed key, the single write that switches readers over.
+    A manifest of each publish records the documents it superseded so they can be garbage collected later.
+
+    Args:
+        bucket_name (str): Bucket the catalog is in.
+        version_prefix (str): Where the publish manifests are kept.
+    """
+
+    def __init__(self, bucket_name, version_prefix):
+        self.bucket_name = bucket_name
+        self.version_prefix = version_prefix
+        self.staged = {}
+        self.replaced = set()
+
+    def add(self, doc, key):
+        """Stage a document under the content addressed version of key. Returns the url it will be at."""
+        digest = content_digest(doc)
+        versioned_key = content_key(key, digest)
+        url = f'https://{self.bucket_name}.s3.amazonaws.com/{versioned_key}'
+        links = [link for link in doc.get("links", []) if link.get("rel") != "self"]
+        links.append({"rel": "self", "href": url, "type": "application/json"})
+        self.staged[versioned_key] = json.dumps({**doc, "links": links})
+        return url
+
+    def replace(self, url):
+        """Record that this publish supersedes the document at url."""
+        key = s3_key(self.bucket_name, url)
+        # only content addressed documents are ever collected, fixed keys are overwritten in place
+        if key is not None and digest_suffix.search(key[:-len(".json")]):
+            self.replaced.add(key)
+
+    def commit(self, s3_client, root_key, root_doc, max_workers=16):
+        """
+        Upload the staged documents in parallel, then the root document, then the manifest.
+
+        A crash before the root is written leaves the old catalog in place with some unreferenced objects,
+        which a rerun writes again under the same keys. Returns the manifest.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(put_document, s3_client, self.bucket_name, key, body, cache="immutable")
+                       for key, body in self.staged.items()]
+            for future in futures:
+                future.result()
+
+        # the switch over, everything the root references is in place by now
+        put_document(s3_client, self.bucket_name, root_key, json.dumps(root_doc), cache="root")
+
+        published = datetime.now(timezone.utc)
+        manifest = {
+            "published": published.isoformat(),
+            "root": root_key,
+            "written": sorted(self.staged),
+            "replaced": sorted(self.replaced - set(self.staged)),
+        }
+        manifest_key = f"{self.version_prefix}/{published.strftime('%Y%m%dT%H%M%S%fZ')}.json"
+        put_document(s3_client, self.bucket_name, manifest_key, json.dumps(manifest), cache="document")
+        return manifest
+
+def manifest_keys(s3_client, bucket_name, version_prefix):
+    """Keys of the publish manifests, oldest first."""
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{version_prefix}/"):
+        keys.extend(content['Key'] for content in page.get('Contents', []))
+    return sorted(keys)
+
+def superseded_keys(s3_client, bucket_name, version_prefix):
+    """Keys the publishes so far have superseded and not written again since, i.e. documents that are no longer current."""
+    superseded = set()
+    for key in manifest_keys(s3_client, bucket_name, version_prefix):
+        manifest = json.loads(read_body(s3_client.get_object(Bucket=bucket_name, Key=key)))
+        superseded |= set(manifest["replaced"])
+        superseded -= set(manifest["written"])
+    return superseded
+
+def collect_garbage(s3_client, bucket_name, version_prefix, keep=7):
+    """
+    Delete the documents superseded by all but the last keep publishes, in bulk.
+
+    A reader still holding one of the last keep roots can finish walking it. A document superseded in one
+    publish but written again in a later one is kept.
+
+    Returns:
+        int: Number of objects deleted.
+    """
+    keys = manifest_keys(s3_client, bucket_name, version_prefix)
+    if len(keys) <= keep:
+        return 0
+
+    manifests = [json.loads(read_body(s3_client.get_object(Bucket=bucket_name, Key=key))) for key in keys]
+    expired = len(keys) - keep
+    doomed = set()
+    for i in range(expired):
+        rewritten = set().union(*(manifest["written"] for manifest in manifests[i + 1:]))
+        doomed |= set(manifests[i]["replaced"]) - rewritten
+    doomed = sorted(doomed) + keys[:expired]
+
+    # delete_objects takes up to 1000 keys a request
+    for start in range(0, len(doomed), 1000):
+        s3_client.delete_objects(Bucket=bucket_name, Delete={"Objects": [{"Key": key} for key in doomed[start:start + 1000]], "Quiet": True})
+    return len(doomed)
@@ -0,0 +1,579 @@
+import os
+import json
+import zlib
+import hashlib
+from datetime import date
+import numpy as np
+import rasterio
+from rasterio.features import rasterize, shapes
+from rasterio.merge import merge
+from rasterio.transform import from_origin
+from rasterio.windows import Window, bounds as window_bounds, transform as window_transform
+from shapely.geometry import box, mapping, shape
+from shapely.ops import unary_union, transform as transform_geometry
+from shapely.strtree import STRtree
+from pyproj import Geod, Transformer
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+
+#Functions to build derived raster products from the daily viirs granules
+
+# viirs flood product class values. 100-200 are flood water fractions of 0-100%
+SNOW = 20
+CLOUD = 30
+WATER_FRACTION_MIN = 100
+WATER_FRACTION_MAX = 200
+
+# nodata value of the derived products, fractions are 0-100 so this never collides
+PRODUCT_NODATA = 255
+
+# (left, bottom, right, top) of the grid every daily mosaic is built on, in the granules EPSG:4326 coordinates.
+# The grid doesn't depend on which granules a day has, so the composites, gap fill and change detection can line days up
+MOSAIC_BOUNDS = (-180.0, -90.0, 180.0, 90.0)
+
+# classes of the flood change product
+NO_CHANGE = 0
+NEWLY_FLOODED = 1
+RECEDED = 2
+change_classes = {NEWLY_FLOODED: "newly_flooded", RECEDED: "receded"}
+change_colormap = {NO_CHANGE: (0, 0, 0, 0), NEWLY_FLOODED: (0, 92, 230, 255), RECEDED: (168, 112, 0, 255)}
+
+# mean earth radius in km, used for pixel areas on geographic grids
+EARTH_RADIUS_KM = 6371.0088
+geod = Geod(ellps="WGS84")
+
+def _fit_block(data, height, width, fill):
+    """Crop or pad a merged block so it matches the destination window exactly."""
+    data = data[:, :height, :width]
+    if data.shape[1] == height and data.shape[2] == width:
+        return data
+    padded = np.full((data.shape[0], height, width), fill, dtype=data.dtype)
+    padded[:, :data.shape[1], :data.shape[2]] = data
+    return padded
+
+def build_daily_mosaic(img_paths, mosaic_path, block_size=512, nodata=None, grid_bounds=MOSAIC_BOUNDS):
+    """
+    Merge all of a days granule TIFs into one COG with internal overviews.
+
+    The merge is done one destination block at a time with rasterio.merge, so only
+    the granules that touch a block are read and the full global mosaic is never held in memory.
+    Blocks no granule touches are left empty, so the fixed global grid costs little on days with few granules.
+
+    Args:
+        img_paths (list): Local paths of the granule TIFs for a single day.
+        mosaic_path (str): Path the mosaic COG is written to.
+        block_size (int): Internal tile size of the mosaic, merging is aligned to these blocks.
+        nodata (int): Fill value for pixels no granule covers. Defaults to the granules nodata or 0.
+        grid_bounds (tuple): (left, bottom, right, top) of the mosaic grid, at the granules resolution.
+    """
+    srcs = [rasterio.open(p) for p in img_paths]
+    merged_path = f"{os.path.splitext(mosaic_path)[0]}_merged.tif"
+    try:
+        first = srcs[0]
+        if nodata is None:
+            nodata = first.nodata if first.nodata is not None else 0
+        xres, yres = first.res
+
+        # the same grid every day whatever granules there are, only the resolution comes from the granules
+        left, bottom, right, top = grid_bounds
+        width = int(round((right - left) / xres))
+        height = int(round((top - bottom) / yres))
+        transform = from_origin(left, top, xres, yres)
+
+        profile = first.profile.copy()
+        profile.update(driver='GTiff', width=width, height=height, transform=transform, nodata=nodata,
+                       tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate')
+
+        try:
+            colormap = first.colormap(1)
+        except ValueError:
+            colormap = None
+
+        with rasterio.open(merged_path, 'w', **profile) as dst:
+            if colormap:
+                dst.write_colormap(1, colormap)
+
+            for _, window in dst.block_windows(1):
+                wleft, wbottom, wright, wtop = window_bounds(window, transform)
+                # only read granules that overlap this block
+                block_srcs = [s for s in srcs if s.bounds.left < wright and s.bounds.right > wleft
+                              and s.bounds.bottom < wtop and s.bounds.top > wbottom]
+                if not block_srcs:
+                    continue
+                data, _ = merge(block_srcs, bounds=(wleft, wbottom, wright, wtop), res=(xres, yres), nodata=nodata)
+                dst.write(_fit_block(data, window.height, window.width, nodata), window=window)
+    finally:
+        for s in srcs:
+            s.close()
+
+    # translate to a COG, this builds the internal overviews. Nearest keeps the class values intact.
+    output_profile = cog_profiles.get("deflate")
+    output_profile.update(blockxsize=block_size, blockysize=block_size)
+    cog_translate(merged_path, mosaic_path, output_profile, overview_resampling="nearest", quiet=True)
+    os.remove(merged_path)
+
+def iter_block_windows(height, width, block_size=512):
+    """Yield the block_size windows that tile a raster of the given shape, row by row."""
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+def window_key(window):
+    """Key a block window by its offsets so it can be stored in a json manifest."""
+    return f"{window.row_off}_{window.col_off}"
+
+def water_fraction(block, nodata):
+    """
+    Split a block of class values into flood water fraction (0-100) and a mask of clear observations.
+
+    Cloud and snow both hide the surface, so neither counts as an observation of the water fraction.
+    """
+    observed = (block != nodata) & (block != CLOUD) & (block != SNOW)
+    is_fraction = (block >= WATER_FRACTION_MIN) & (block <= WATER_FRACTION_MAX)
+    fraction = np.where(is_fraction, block.astype(np.int16) - WATER_FRACTION_MIN, 0).astype(np.uint8)
+    return fraction, observed
+
+def block_signatures(img_path, block_size=512):
+    """
+    Compute a checksum of every block of a daily raster.
+
+    Blocks without a single clear observation get None since they can't change any composite.
+    These are what the temporal composites use to tell which of their windows need recomputing.
+    """
+    signatures = {}
+    with rasterio.open(img_path) as src:
+        nodata = src.nodata if src.nodata is not None else 0
+        for window in iter_block_windows(src.height, src.width, block_size):
+            block = src.read(1, window=window)
+            _, observed = water_fraction(block, nodata)
+            signatures[window_key(window)] = format(zlib.crc32(block.tobytes()), '08x') if observed.any() else None
+    return signatures
+
+def load_or_compute_signatures(img_path, signature_path, source_tag, block_size=512):
+    """
+    Read a days block signatures from disk, computing and saving them when they aren't there for this version of the raster.
+
+    Args:
+        img_path (str): The days raster, path or url.
+        signature_path (str): Where the days signatures are cached.
+        source_tag (str): Identifies the rasters content (e.g. its s3 ETag). Cached signatures of any other content,
+            from before the day was reprocessed, are recomputed.
+        block_size (int): Size of the blocks the signatures are computed over.
+    """
+    if os.path.exists(signature_path):
+        with open(signature_path) as f:
+            cached = json.load(f)
+        if cached.get("source") == source_tag and cached.get("block_size") == block_size:
+            return cached["signatures"]
+    signatures = block_signatures(img_path, block_size)
+    os.makedirs(os.path.dirname(signature_path), exist_ok=True)
+    with open(signature_path, 'w') as f:
+        json.dump({"source": source_tag, "block_size": block_size, "signatures": signatures}, f)
+    return signatures
+
+def build_temporal_composite(inputs, signatures, out_path, previous_path=None, previous_manifest=None, block_size=512):
+    """
+    Build a multi-day composite of max flood water fraction, mean flood water fraction and observation count.
+
+    Blocks are streamed one window at a time from the daily rasters so the stack is never loaded in full.
+    A window is only recomputed when the signatures of the days contributing to it differ from the
+    previous run, otherwise it is copied straight out of the previous composite.
+
+    Args:
+        inputs (list): (day, path or url) of the daily rasters, all on the same grid.
+        signatures (dict): Block signatures of each day, as returned by block_signatures.
+        out_path (str): Path of the tiled 3 band GeoTIFF to write (max, mean, count).
+        previous_path (str): Previous composite written by this function, if there is one.
+        previous_manifest (dict): Manifest returned by the run that wrote previous_path.
+        block_size (int): Window size, must match the size the signatures were computed with.
+
+    Returns:
+        tuple: (manifest of the contributing signatures per window, number of windows recomputed)
+    """
+    srcs = {day: rasterio.open(path) for day, path in inputs}
+    previous = rasterio.open(previous_path) if previous_path and previous_manifest is not None else None
+    manifest = {}
+    recomputed = 0
+    try:
+        first = next(iter(srcs.values()))
+        nodata = first.nodata if first.nodata is not None else 0
+        for day, src in srcs.items():
+            if src.shape != first.shape or src.transform != first.transform:
+                raise ValueError(f"Input for {day} is not on the same grid as the other days")
+
+        profile = first.profile.copy()
+        profile.update(driver='GTiff', count=3, dtype='uint8', nodata=PRODUCT_NODATA,
+                       tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate')
+        profile.pop('photometric', None)
+
+        with rasterio.open(out_path, 'w', **profile) as dst:
+            dst.descriptions = ("max_water_fraction", "mean_water_fraction", "observation_count")
+            for window in iter_block_windows(dst.height, dst.width, block_size):
+                key = window_key(window)
+                contributing = [day for day in srcs if signatures[day].get(key) is not None]
+                # the result only depends on which block contents go into it, not which day they came from
+                manifest[key] = sorted(signatures[day][key] for day in contributing)
+
+                if previous is not None and previous_manifest.get(key) == manifest[key]:
+                    dst.write(previous.read(window=window), window=window)
+                    continue
+
+                recomputed += 1
+                max_fraction = np.zeros((window.height, window.width), dtype=np.uint8)
+                sum_fraction = np.zeros((window.height, window.width), dtype=np.uint16)
+                count = np.zeros((window.height, window.width), dtype=np.uint8)
+                for day in contributing:
+                    fraction, observed = water_fraction(srcs[day].read(1, window=window), nodata)
+                    fraction = np.where(observed, fraction, 0).astype(np.uint8)
+                    np.maximum(max_fraction, fraction, out=max_fraction)
+                    sum_fraction += fraction
+                    count += observed
+
+                has_obs = count > 0
+                mean_fraction = np.full(count.shape, PRODUCT_NODATA, dtype=np.uint8)
+                mean_fraction[has_obs] = np.round(sum_fraction[has_obs] / count[has_obs])
+                max_fraction[~has_obs] = PRODUCT_NODATA
+                dst.write(np.stack([max_fraction, mean_fraction, count]), window=window)
+    finally:
+        for src in srcs.values():
+            src.close()
+        if previous is not None:
+            previous.close()
+
+    return manifest, recomputed
+
+def update_gap_filled(today_path, state_path, out_path, day, lookback=7, block_size=512):
+    """
+    Fill cloud and snow covered pixels of a daily raster with the most recent clear observation.
+
+    A rolling state raster holds the last clear value of every pixel and how many days old it is,
+    so each new day is a single block-wise pass over todays raster and the state, never the history.
+    The state from before the last day applied is kept next to it, so rerunning that day rebuilds it
+    from there instead of folding the day in twice. A state on a different grid than todays raster is
+    started over, and a day older than the state raises ValueError.
+
+    Args:
+        today_path (str): Todays raster of class values.
+        state_path (str): State raster (last clear value, age in days). Created on the first run and updated in place,
+            the state it replaces is kept with a _previous suffix.
+        out_path (str): Path of the gap filled GeoTIFF to write, it keeps todays colormap.
+        day (date): Date of todays raster.
+        lookback (int): Oldest observation in days that is still carried forward.
+        block_size (int): Size of the blocks the rasters are processed in.
+    """
+    with rasterio.open(today_path) as src:
+        nodata = src.nodata if src.nodata is not None else 0
+        profile = src.profile.copy()
+        try:
+            colormap = src.colormap(1)
+        except ValueError:
+            colormap = None
+
+        previous_state_path = f"{os.path.splitext(state_path)[0]}_previous.tif"
+        state = None
+        elapsed = None
+        rerun = False
+        if os.path.exists(state_path):
+            with rasterio.open(state_path) as current:
+                state_day = date.fromisoformat(current.tags()['STATE_DATE'])
+            if state_day > day:
+                raise ValueError(f"Gap fill state is already at {state_day}, can't apply {day} to it")
+            base_path = state_path
+            if state_day == day:
+                # today was applied before, rebuild it from the state it was applied to
+                rerun = True
+                base_path = previous_state_path if os.path.exists(previous_state_path) else None
+            if base_path is not None:
+                state = rasterio.open(base_path)
+                elapsed = (day - date.fromisoformat(state.tags()['STATE_DATE'])).days
+                if elapsed <= 0 or state.shape != src.shape or state.transform != src.transform:
+                    print(f"Gap fill state {base_path} can't be applied to {day}, starting the state over")
+                    state.close()
+                    state = None
+
+        profile.update(driver='GTiff', tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate')
+        state_profile = profile.copy()
+        state_profile.update(count=2, dtype='uint8', nodata=None)
+        state_profile.pop('photometric', None)
+        new_state_path = f"{os.path.splitext(state_path)[0]}_new.tif"
+
+        try:
+            with rasterio.open(out_path, 'w', **profile) as dst, rasterio.open(new_state_path, 'w', **state_profile) as new_state:
+                if colormap:
+                    dst.write_colormap(1, colormap)
+                new_state.update_tags(STATE_DATE=day.isoformat())
+                new_state.descriptions = ("last_clear_value", "age_days")
+
+                for window in iter_block_windows(src.height, src.width, block_size):
+                    block = src.read(1, window=window)
+                    if state is not None:
+                        last_value, age = state.read(window=window)
+                        # 255 marks pixels that have never had a clear observation
+                        age = np.where(age == 255, 255, np.minimum(age.astype(np.uint16) + elapsed, 254)).astype(np.uint8)
+                    else:
+                        last_value = np.full(block.shape, nodata, dtype=block.dtype)
+                        age = np.full(block.shape, 255, dtype=np.uint8)
+
+                    clear = (block != nodata) & (block != CLOUD) & (block != SNOW)
+                    last_value = np.where(clear, block, last_value)
+                    age = np.where(clear, 0, age).astype(np.uint8)
+
+                    # carry the last clear value forward where it's recent enough, otherwise keep todays value
+                    dst.write(np.where(age <= lookback, last_value, block)[np.newaxis], window=window)
+                    new_state.write(np.stack([last_value.astype(np.uint8), age]), window=window)
+        finally:
+            if state is not None:
+                state.close()
+
+    # a rerun of the same day keeps the state it was built from, otherwise the replaced state becomes the previous one
+    if not rerun and os.path.exists(state_path):
+        os.replace(state_path, previous_state_path)
+    os.replace(new_state_path, state_path)
+
+def load_zones(zones_path, id_field, layer=None):
+    """
+    Load zone polygons (states, HUCs, counties...) in EPSG:4326 from a GeoJSON file or a GeoPackage layer.
+
+    Returns:
+        tuple: (list of zone ids, list of shapely geometries, hash of the zone file). Zone i gets label i + 1 when rasterized.
+    """
+    # the labels depend on the file contents and the layer read from it, so that's what rasterized labels are cached by
+    zones_hash = hashlib.sha1()
+    with open(zones_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            zones_hash.update(chunk)
+    zones_hash.update(str(layer).encode())
+
+    if zones_path.endswith('.gpkg'):
+        # fiona is only needed for GeoPackages
+        import fiona
+        with fiona.open(zones_path, layer=layer) as features:
+            if features.crs and features.crs.to_epsg() not in (None, 4326):
+                raise ValueError(f"Zones in {zones_path} must be in EPSG:4326")
+            features = [(feature['properties'][id_field], shape(feature['geometry'])) for feature in features]
+    else:
+        with open(zones_path) as f:
+            features = [(feature['properties'][id_field], shape(feature['geometry'])) for feature in json.load(f)['features']]
+    zone_ids = [zone_id for zone_id, _ in features]
+    geometries = [geometry for _, geometry in features]
+    return zone_ids, geometries, zones_hash.hexdigest()
+
+def rasterize_zone_block(geometries, tree, window, transform):
+    """Rasterize the zones that touch a window to a block of labels, 0 where no zone covers a pixel."""
+    out_shape = (int(window.height), int(window.width))
+    block_transform = window_transform(window, transform)
+    candidates = tree.query(box(*window_bounds(window, transform)))
+    if len(candidates) == 0:
+        return np.zeros(out_shape, dtype=np.int32)
+    return rasterize([(geometries[i], int(i) + 1) for i in candidates], out_shape=out_shape,
+                     transform=block_transform, fill=0, dtype='int32')
+
+def pixel_area_km2(window, transform):
+    """Area of the pixels in each row of a window on a geographic grid, as a column that broadcasts over the block."""
+    rows = np.arange(window.row_off, window.row_off + window.height)
+    lat_top = np.radians(transform.f + rows * transform.e)
+    lat_bottom = np.radians(transform.f + (rows + 1) * transform.e)
+    # exact area of a lat/lon cell on a sphere
+    area = EARTH_RADIUS_KM ** 2 * np.radians(abs(transform.a)) * np.abs(np.sin(lat_top) - np.sin(lat_bottom))
+    return area[:, np.newaxis]
+
+def detect_flood_change(previous_path, today_path, out_path, zones=None, flood_threshold=1, block_size=512):
+    """
+    Compare todays raster with the previous days block by block and map where flooding appeared or receded.
+
+    Pixels are only compared where both days have a clear observation. A pixel is flooded when its flood
+    water fraction is at least flood_threshold percent.
+
+    Args:
+        previous_path (str): Previous days raster of class values, path or url.
+        today_path (str): Todays raster of class values, on the same grid.
+        out_path (str): Path of the change GeoTIFF (0 no change, 1 newly flooded, 2 receded) to write.
+        zones (tuple): Optional zones from load_zones to summarize areas by.
+        flood_threshold (int): Water fraction in percent at which a pixel counts as flooded.
+        block_size (int): Size of the blocks the rasters are compared in.
+
+    Returns:
+        dict: GeoJSON FeatureCollection of the change polygons with their areas, plus a "summary"
+        member with the total and per zone area in km2 of each change class.
+    """
+    if zones is not None:
+        zone_ids, geometries, _ = zones
+        tree = STRtree(geometries)
+        zone_area = {cls: np.zeros(len(zone_ids) + 1) for cls in change_classes}
+    polygons = {cls: [] for cls in change_classes}
+    total_area = {cls: 0.0 for cls in change_classes}
+
+    with rasterio.open(previous_path) as prev, rasterio.open(today_path) as today:
+        if prev.shape != today.shape or prev.transform != today.transform:
+            raise ValueError("The previous and current day are not on the same grid")
+        if not today.crs.is_geographic:
+            raise ValueError("Change areas can only be computed on a geographic grid")
+        nodata = today.nodata if today.nodata is not None else 0
+
+        profile = today.profile.copy()
+        profile.update(driver='GTiff', count=1, dtype='uint8', nodata=None,
+                       tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate')
+        with rasterio.open(out_path, 'w', **profile) as dst:
+            dst.write_colormap(1, change_colormap)
+            for window in iter_block_windows(today.height, today.width, block_size):
+                prev_fraction, prev_observed = water_fraction(prev.read(1, window=window), nodata)
+                fraction, observed = water_fraction(today.read(1, window=window), nodata)
+                comparable = prev_observed & observed
+                prev_flooded = prev_fraction >= flood_threshold
+                flooded = fraction >= flood_threshold
+
+                change = np.full(fraction.shape, NO_CHANGE, dtype=np.uint8)
+                change[comparable & flooded & ~prev_flooded] = NEWLY_FLOODED
+                change[comparable & prev_flooded & ~flooded] = RECEDED
+                dst.write(change[np.newaxis], window=window)
+
+                if not change.any():
+                    continue
+
+                area = np.broadcast_to(pixel_area_km2(window, today.transform), change.shape)
+                if zones is not None:
+                    labels = rasterize_zone_block(geometries, tree, window, today.transform)
+                for cls in change_classes:
+                    is_cls = change == cls
+                    total_area[cls] += area[is_cls].sum()
+                    if zones is not None:
+                        zone_area[cls] += np.bincount(labels[is_cls], weights=area[is_cls], minlength=len(zone_ids) + 1)
+
+                block_transform = window_transform(window, today.transform)
+                for geom, value in shapes(change, mask=change != NO_CHANGE, transform=block_transform):
+                    polygons[int(value)].append(shape(geom))
+
+    features = []
+    for cls, name in change_classes.items():
+        # polygons are vectorized per block so merge the pieces split across block edges
+        merged = unary_union(polygons[cls]) if polygons[cls] else None
+        if merged is None:
+            continue
+        for polygon in getattr(merged, 'geoms', [merged]):
+            features.append({
+                "type": "Feature",
+                "geometry": mapping(polygon),
+                "properties": {"change": name, "area_km2": round(abs(geod.geometry_area_perimeter(polygon)[0]) / 1e6, 4)},
+            })
+
+    summary = {name: {"area_km2": round(float(total_area[cls]), 4)} for cls, name in change_classes.items()}
+    if zones is not None:
+        for cls, name in change_classes.items():
+            # label 0 is the area outside every zone
+            summary[name]["zones"] = {str(zone_id): round(float(zone_area[cls][i + 1]), 4)
+                                      for i, zone_id in enumerate(zone_ids) if zone_area[cls][i + 1] > 0}
+
+    return {"type": "FeatureCollection", "features": features, "summary": summary}
+
+def zone_cache_path(cache_dir, crs, transform, grid_shape, zones_hash):
+    """Path of the cached label grid for a grid signature (crs, transform, shape) and zone file."""
+    grid_key = hashlib.sha1(f"{crs.to_string()}|{tuple(transform)}|{tuple(grid_shape)}|{zones_hash}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{grid_key}.npy")
+
+def evict_zone_cache(cache_dir, max_bytes, keep=None):
+    """Delete the least recently used label grids until the cache fits in max_bytes of disk."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    # oldest access first, hits bump the modification time
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+
+def zone_label_raster(zones, crs, transform, grid_shape, cache_dir, max_cache_bytes=2 * 1024 ** 3):
+    """
+    Rasterize zones onto a grid, memory mapping the cached label grid instead if it has been rasterized before.
+
+    The cache is keyed by the grid signature and the zone file hash, so each granule tile only
+    ever gets rasterized once per zone file. Least recently used grids are evicted to stay under max_cache_bytes.
+
+    Args:
+        zones (tuple): Zones from load_zones.
+        crs, transform, grid_shape: Grid to rasterize onto.
+        cache_dir (str): Directory the label grids are cached in as .npy files.
+        max_cache_bytes (int): Disk budget of the cache.
+
+    Returns:
+        ndarray: Labels of the grid, zone i is labelled i + 1 and 0 is outside every zone.
+    """
+    zone_ids, geometries, zones_hash = zones
+    label_path = zone_cache_path(cache_dir, crs, transform, grid_shape, zones_hash)
+    if os.path.exists(label_path):
+        # mark it recently used for eviction
+        os.utime(label_path)
+        return np.load(label_path, mmap_mode='r')
+
+    # zones are in EPSG:4326, move them onto the grid if it is in anything else
+    if crs.to_epsg() != 4326:
+        transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        geometries = [transform_geometry(transformer.transform, g) for g in geometries]
+
+    dtype = 'uint16' if len(zone_ids) < np.iinfo(np.uint16).max else 'int32'
+    height, width = grid_shape
+    grid_box = box(transform.c, transform.f + height * transform.e, transform.c + width * transform.a, transform.f)
+    candidates = STRtree(geometries).query(grid_box)
+    if len(candidates) == 0:
+        labels = np.zeros(grid_shape, dtype=dtype)
+    else:
+        labels = rasterize([(geometries[i], int(i) + 1) for i in candidates], out_shape=grid_shape,
+                           transform=transform, fill=0, dtype=dtype)
+
+    # write to a temporary name first so a concurrent run never maps a half written grid
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{label_path[:-4]}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, labels)
+    os.replace(tmp_path, label_path)
+    evict_zone_cache(cache_dir, max_cache_bytes, keep=label_path)
+    return labels
+
+def zonal_stats(img_path, zones, cache_dir, max_cache_bytes=2 * 1024 ** 3):
+    """
+    Compute the flooded area and cloud and snow cover percent of every zone a raster touches.
+
+    All zones are computed at once with bincounts over the cached zone label raster.
+
+    Returns:
+        dict: {zone id: {"flooded_area_km2", "cloud_percent", "snow_percent"}} of the zones with pixels in the raster.
+    """
+    zone_ids, _, _ = zones
+    with rasterio.open(img_path) as src:
+        block = src.read(1)
+        nodata = src.nodata if src.nodata is not None else 0
+        labels = zone_label_raster(zones, src.crs, src.transform, src.shape, cache_dir, max_cache_bytes).ravel()
+        window = Window(0, 0, src.width, src.height)
+        if src.crs.is_geographic:
+            area = np.broadcast_to(pixel_area_km2(window, src.transform), block.shape).ravel()
+        else:
+            area = np.full(block.size, abs(src.transform.a * src.transform.e) / 1e6)
+
+    fraction, _ = water_fraction(block, nodata)
+    block = block.ravel()
+    n_labels = len(zone_ids) + 1
+
+    # one pass over a combined (zone, category) index counts valid, cloud and snow pixels of every zone together
+    category = np.zeros(block.size, dtype=np.int64)
+    category[block == CLOUD] = 1
+    category[block == SNOW] = 2
+    category[block == nodata] = 3
+    counts = np.bincount(labels.astype(np.int64) * 4 + category, minlength=n_labels * 4).reshape(n_labels, 4)
+    flooded_area = np.bincount(labels, weights=area * fraction.ravel() / 100, minlength=n_labels)
+
+    stats = {}
+    for i, zone_id in enumerate(zone_ids, start=1):
+        valid = counts[i, :3].sum()
+        if valid == 0:
+            continue
+        stats[str(zone_id)] = {
+            "flooded_area_km2": round(float(flooded_area[i]), 4),
+            "cloud_percent": float(np.round(counts[i, 1] / valid * 100, 2)),
+            "snow_percent": float(np.round(counts[i, 2] / valid * 100, 2)),
+        }
+    return stats
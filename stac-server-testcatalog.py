@@ -1,4 +1,7 @@
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 import logging
 import requests
 from bs4 import BeautifulSoup
@@ -9,6 +12,8 @@ import urllib.request
 import pystac
 from pystac.extensions.projection import ProjectionExtension
 from pystac.extensions.eo import EOExtension
+from pystac.extensions.item_assets import ItemAssetsExtension
+from pystac.utils import datetime_to_str
 from datetime import datetime, timezone, timedelta
 from shapely.geometry import Polygon, mapping, box
 from pyproj import Transformer
@@ -21,14 +26,27 @@ from datetime import date
 from botocore.exceptions import NoCredentialsError, ClientError
 from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
-from pypgstac.db import PgstacDB
-from pypgstac.load import Loader, Methods
+from pypgstac.load import Methods
 
 import stac_mod as sm
+import raster_mod as rm
+import tile_mod as tm
+import pgstac_mod as pm
+import item_mod as im
+import export_mod as em
+import publish_mod as pb
 
 # set logging level for boto3
 logging.basicConfig(level=logging.INFO)
 
+# fields every viirs-1-day-composite item has in common, items are rendered from this plus their own fields
+itemTemplatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viirs-item-template.json')
+viirs_item_template = im.load_item_template(itemTemplatePath)
+
+# validate against the STAC schemas kept in the schemas folder, fetching any that are missing into it
+schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+im.use_local_schemas(schema_dir, viirs_item_template["stac_extensions"] + [ItemAssetsExtension.get_schema_uri()])
+
 ########### collection specific defitions
 #TODO these will get moved to their own files once you refactor so that every collections analysis and creation is happening in its own folder/namespace
 def get_item_datetime(filename):
@@ -49,13 +67,14 @@ def get_item_datetime(filename):
 
     return start_datetime, end_datetime
 
-# function that writes an updated stac collection file to s3 and loads into database
-def update_collection(collection,collection_object_key,bucket_name,loader,s3):
+# function that writes an updated stac collection file to s3 and loads into database. When partition_trunc and a
+# (start date, end date) partition_range are given the collection's pgstac partitioning is set up for that range too
+def update_collection(collection,collection_object_key,bucket_name,loader,s3,partition_trunc=None,partition_range=None):
     # Convert the collection to a JSON string
-    collection_json = json.dumps(collection.to_dict())
+    collection_dict = collection.to_dict()
 
-    # Write the collection JSON string to the S3 bucket
-    s3.put_object(Body=collection_json, Bucket=bucket_name, Key=collection_object_key, ContentType='application/json')
+    # Write the collection JSON string to the S3 bucket, it's a root that changes every run so it's only cached briefly
+    pb.put_document(s3, bucket_name, collection_object_key, json.dumps(collection_dict), cache="root")
 
     # validate the collection
     try:
@@ -64,8 +83,92 @@ def update_collection(collection,collection_object_key,bucket_name,loader,s3):
     except Exception as e:
         print(f"Validation error: {e}")
 
-    # upsert the new/modified collection item to the catalog
-    loader.load_collections(file=collection.self_href, insert_mode=Methods.upsert)
+    # upsert the new/modified collection item to the catalog on a connection borrowed from the pool
+    with loader.db:
+        loader.load_collections(file=[collection_dict], insert_mode=Methods.upsert)
+
+        # partition items by time and create the partitions the items are about to be loaded into
+        if partition_trunc is not None and partition_range is not None:
+            pm.configure_partitions(loader.db, collection.id, partition_trunc, *partition_range)
+
+# item properties the collection's queryables advertise: name -> (json schema definition, whether pgstac should index it)
+viirs_queryables = {
+    "eo:cloud_cover": ({"title": "Cloud Cover", "description": "Percent of the image covered by cloud", "type": "number", "minimum": 0, "maximum": 100}, True),
+    "eo:snow_cover": ({"title": "Snow Cover", "description": "Percent of the image covered by snow", "type": "number", "minimum": 0, "maximum": 100}, True),
+    "flooded_percent": ({"title": "Flooded Percent", "description": "Percent of the valid pixels with flood water", "type": "number", "minimum": 0, "maximum": 100}, True),
+    "start_datetime": ({"title": "Start Datetime", "type": "string", "format": "date-time"}, False),
+    "end_datetime": ({"title": "End Datetime", "type": "string", "format": "date-time"}, False),
+    "platform": ({"title": "Platform", "type": "string"}, False),
+    "instrument": ({"title": "Instrument", "type": "string"}, False),
+    "constellation": ({"title": "Constellation", "type": "string"}, False),
+    "gsd": ({"title": "Ground Sample Distance", "type": "number"}, False),
+    "processing level": ({"title": "Processing Level", "type": "string"}, False),
+}
+
+# key of a days global mosaic in the bucket
+def get_mosaic_key(day):
+    day_string = day.strftime('%Y-%m-%d')
+    return f"mosaics/viirs-1-day/{day_string}/viirs-1-day-mosaic-{day_string}.tif"
+
+# key of a year=YYYY/month=MM stac-geoparquet partition of the items in the bucket
+def get_geoparquet_key(partition):
+    return f"geoparquet/viirs-1-day-composite/{partition}/items.parquet"
+
+# keys of the gzipped NDJSON rollups of all the items of a day and of a month
+def get_day_rollup_key(day):
+    return f"items/viirs-1-day/{day.strftime('%Y/%m/%d')}/viirs-1-day-{day.strftime('%Y-%m-%d')}.ndjson.gz"
+
+def get_month_rollup_key(day):
+    return f"items/viirs-1-day/{day.strftime('%Y/%m')}/viirs-1-day-{day.strftime('%Y-%m')}.ndjson.gz"
+
+# function that creates a collection for a product derived from the viirs-1-day-composite collection
+def create_derived_collection(product_name, description, start_datetime, bucket_name):
+    derived_collection = pystac.Collection(
+        id=f'{product_name}-composite',
+        description=description,
+        title=f'{product_name}-composite',
+        keywords=["VIIRS", "flood", "composite", "surface water"],
+        extent=pystac.Extent(
+            spatial=pystac.SpatialExtent([[-180, -90, 180, 90]]),
+            temporal=pystac.TemporalExtent([[start_datetime, None]])
+        ),
+        license='CC0-1.0',
+    )
+
+    derived_collection.add_link(pystac.Link(
+        rel="derived_from",
+        target=f'https://{bucket_name}.s3.amazonaws.com/collections/viirs-1-day/viirs-1-day.json',
+        title='viirs-1-day-composite',
+        media_type='application/json'
+    ))
+
+    derived_collection.stac_version = "1.0.0"
+    derived_collection.providers = [
+        pystac.Provider(name="NOAA NESDIS", roles=["producer", "licensor"], url="https://www.nesdis.noaa.gov/"),
+        pystac.Provider(name="VIIRS Flood Team at George Mason University", roles=["producer"], url="https://fhrl.vse.gmu.edu/"),
+    ]
+
+    derived_collection_key = f'collections/{product_name}/{product_name}.json'
+    derived_collection.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{derived_collection_key}')
+    return derived_collection, derived_collection_key
+
+# function that writes an item of a derived product to s3, loads it into the database and updates its collection
+def publish_derived_item(item, product_name, derived_collection, derived_collection_key, bucket_name, loader, s3):
+    derived_collection.add_item(item)
+
+    item_key = f'items/{product_name}/{item.datetime.strftime("%Y/%m/%d")}/{item.id}.json'
+    item.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{item_key}')
+
+    try:
+        item.validate()
+    except Exception as e:
+        print(f"Validation error: {e}")
+
+    item_dict = item.to_dict()
+    pb.put_document(s3, bucket_name, item_key, json.dumps(item_dict), encoding=jsonContentEncoding)
+    with loader.db:
+        loader.load_items(file=[item_dict], insert_mode=Methods.upsert)
+    update_collection(derived_collection, derived_collection_key, bucket_name, loader, s3)
 
 def generate_date_range(start_date, end_date):
     for n in range(int((end_date - start_date).days)):
@@ -89,260 +192,697 @@ def list_tifs_in_bucket(bucket, prefix, client):
 # Set switch to update or keep current collection
 updateCollection = True
 
-# Create an S3 client 
-s3 = boto3.client('s3')
-
-# Specify your bucket name
-bucket_name = 'fim-public'
-
-# Initialize the loader with your database 
-db = PgstacDB(debug=True)
-loader = Loader(db)
-
-# Key for the collection object in the S3 bucket, within the "collections" folder
-collection_object_key = 'collections/viirs-1-day/viirs-1-day.json'
-
-# check if the collection object exists in the S3 bucket
-try:
-    s3.head_object(Bucket=bucket_name, Key=collection_object_key)
-    object_exists = True
-except ClientError as error:
-    object_exists = False
-
-if object_exists and not updateCollection:
-    print("The collection exists and updateCollection is False. Skipping creation and will only update items.")
-    # Download the existing collection JSON from S3
-    response = s3.get_object(Bucket=bucket_name, Key=collection_object_key)
-    collection_json = response['Body'].read()
-    collection_dict = json.loads(collection_json)
-    collection = pystac.Collection.from_dict(collection_dict)
-    print("Existing collection loaded successfully.")
-
-else:
-    print("Proceeding with collection creation and upserting...")
-
-    # date from which data for the collection begins
-    start_date = date(2012, 1, 21)  # Modify this date as per your data storage requirement
-    yesterday_date = datetime.utcnow().date() - timedelta(days=1)
-
-    # Convert the start_date to a datetime object with timezone info
-    start_datetime = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc)
-
-    # This is the top level viirs-1-day collection. It will host sub-collections where the main thing that is different
-    # that the temporal extent will be the 24 hour period the composite was created in 0 Z.
-    collection = pystac.Collection(
-        id='viirs-1-day-composite',
-        description='VIIRS 1-day composite flood water fraction product collection. Please contact slia at gmu.edu for product specific questions.',
-        title = "viirs-1-day-composite",
-        keywords = ["VIIRS", "flood", "composite", "daily", "surface water"],
-        extent=pystac.Extent(
-            spatial=pystac.SpatialExtent([[-180, -90, 180, 90]]),
-            temporal=pystac.TemporalExtent([[start_datetime, None]])
-        ),
-        license='CC0-1.0',
-    )
+# How pgstac partitions the collection's items by time, 'month' or 'year'
+partitionTrunc = 'month'
+
+# Set switch to bulk load items into pgstac from a local spool of dehydrated items instead of one load per item from s3,
+# where the spool is kept and how many items are spooled before they are loaded
+bulkIngest = False
+bulkIngestSpoolPath = '/home/dylan/wncat/item-spool.tsv'
+bulkIngestBatchSize = 1000
+
+# How items are validated (always, sample, structural or deferred, see item_mod.validation_policies), 1 in how many
+# items are fully validated with the sample policy, and the file validation failures are reported to
+validationPolicy = 'always'
+validationSampleEvery = 100
+validationReportPath = '/home/dylan/wncat/validation-report.ndjson'
+
+# Set switch to merge each days granules into a single global mosaic COG
+buildDailyMosaic = True
+
+# Set switch to write a MosaicJSON tile index for each day and the quadkey zoom it is keyed on
+buildTileIndex = True
+tileIndexZoom = 6
+
+# Set switch to export a static XYZ tile pyramid of each days mosaic (needs buildDailyMosaic), the zooms it covers and the tile format (PNG or WEBP)
+exportTilePyramid = False
+tilePyramidMaxZoom = 6
+tilePyramidFormat = 'PNG'
+
+# Set switch to build rolling multi-day composites (max/mean water fraction and observation count) of the daily mosaics
+# (needs buildDailyMosaic), the periods in days and where the state for incremental updates is kept between runs
+buildTemporalComposites = True
+compositePeriods = [3, 7, 30]
+compositeStateDir = '/home/dylan/wncat/composite-state'
+
+# Set switch to build a cloud/snow gap filled daily product from the mosaics (needs buildDailyMosaic) and how many days back a clear observation is carried forward
+buildGapFilled = True
+gapFillLookback = 7
+
+# Set switch to build a newly flooded/receded product against the previous days mosaic (needs buildDailyMosaic),
+# and optionally a GeoJSON of zones (states, HUCs...) plus the property holding their ids to summarize the change areas by
+buildFloodChange = True
+changeZonesPath = None
+changeZonesIdField = 'NAME'
+
+# Zone sets (GeoJSON or GeoPackage in EPSG:4326 and the property holding the zone ids) to compute per item flooded area and
+# cloud/snow cover for, e.g. {'us-states': ('/home/dylan/wncat/zones/us-states.gpkg', 'STUSPS')}. Their rasterized labels are cached in zoneCacheDir
+# up to zoneCacheMaxBytes of disk
+zonalStatsZones = {}
+zoneCacheDir = '/home/dylan/wncat/zone-cache'
+zoneCacheMaxBytes = 2 * 1024 ** 3
+
+# Set switch to export all items to stac-geoparquet files partitioned by year/month (needs stac-geoparquet installed in the venv).
+# Only the partitions a run adds items to are rewritten, from the items staged for them in geoparquetStageDir
+exportGeoparquet = False
+geoparquetStageDir = '/home/dylan/wncat/geoparquet-stage'
+
+# Set switch to keep gzipped NDJSON rollups of the items of every day and month next to the item json, so clients
+# syncing the static items can fetch a month in one request
+buildNdjsonRollups = True
+
+# Content-Encoding the item json and change summaries are published with, "gzip", "br" or None for uncompressed.
+# Clients that read them through boto3, s3:// or pystac's default StacIO can't decode them, so it's off by default.
+# The collections and MosaicJSON tile indexes are always uploaded uncompressed
+jsonContentEncoding = None
+
+# the process pools (tile rendering, deferred validation) start their workers by spawning a fresh interpreter that
+# imports this script, so only the settings and functions above run at import and the pipeline itself runs under this guard
+if __name__ == "__main__":
+    # the export runs at the very end, so check its dependencies before anything is built or loaded
+    if exportGeoparquet:
+        em.require_geoparquet()
+
+    # Create an S3 client 
+    s3 = boto3.client('s3')
+
+    # Specify your bucket name
+    bucket_name = 'fim-public'
+
+    # Format of the item thumbnails, 'PNG' (palette mode) or 'WEBP' (lossless). Both reproduce the products colormap exactly
+    thumbnailFormat = 'PNG'
+
+    # Number of threads the per item thumbnail, COG and item json uploads run on concurrently
+    uploadWorkers = 16
+
+    # Size of the pgstac connection pool shared by the pipeline and any concurrent workers, and whether pgstac debug logging is on
+    pgstacPoolSize = 4
+    pgstacDebug = False
+
+    # Set switch to skip building the items of granules that are already loaded in pgstac, e.g. when restarting a backfill.
+    # The days mosaic, tile index and derived products are still built from all of its granules
+    skipExistingItems = False
+
+    # Initialize the pool of database connections and the loader that uses it for the whole run,
+    # each database step borrows a connection for as long as it runs
+    db_pool = pm.create_pool(max_size=pgstacPoolSize)
+    loader = pm.pooled_loader(db_pool, debug=pgstacDebug)
+
+    # Key for the collection object in the S3 bucket, within the "collections" folder
+    collection_object_key = 'collections/viirs-1-day/viirs-1-day.json'
+
+    # check if the collection object exists in the S3 bucket
+    try:
+        s3.head_object(Bucket=bucket_name, Key=collection_object_key)
+        object_exists = True
+    except ClientError as error:
+        object_exists = False
+
+    if object_exists and not updateCollection:
+        print("The collection exists and updateCollection is False. Skipping creation and will only update items.")
+        # Download the existing collection JSON from S3
+        response = s3.get_object(Bucket=bucket_name, Key=collection_object_key)
+        collection_json = pb.read_body(response)
+        collection_dict = json.loads(collection_json)
+        collection = pystac.Collection.from_dict(collection_dict)
+        print("Existing collection loaded successfully.")
+
+        # collections made before the item template existed don't have its asset definitions yet
+        if im.set_item_assets(collection, viirs_item_template):
+            update_collection(collection, collection_object_key, bucket_name,loader, s3)
 
-    collection.add_link(pystac.Link(
-        rel="related",
-        target='https://waternode.ciroh.org/data-guide.html',
-        title='VIIRS composite flood map entry in WPN data guide',
-        media_type='text/html'
-    ))
+    else:
+        print("Proceeding with collection creation and upserting...")
+
+        # date from which data for the collection begins
+        start_date = date(2012, 1, 21)  # Modify this date as per your data storage requirement
+        yesterday_date = datetime.utcnow().date() - timedelta(days=1)
+
+        # Convert the start_date to a datetime object with timezone info
+        start_datetime = datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc)
+
+        # This is the top level viirs-1-day collection. It will host sub-collections where the main thing that is different
+        # that the temporal extent will be the 24 hour period the composite was created in 0 Z.
+        collection = pystac.Collection(
+            id='viirs-1-day-composite',
+            description='VIIRS 1-day composite flood water fraction product collection. Please contact slia at gmu.edu for product specific questions.',
+            title = "viirs-1-day-composite",
+            keywords = ["VIIRS", "flood", "composite", "daily", "surface water"],
+            extent=pystac.Extent(
+                spatial=pystac.SpatialExtent([[-180, -90, 180, 90]]),
+                temporal=pystac.TemporalExtent([[start_datetime, None]])
+            ),
+            license='CC0-1.0',
+        )
 
-    # add a queryables link
-    collection.add_link(pystac.Link(
-        rel="http://www.opengis.net/def/rel/ogc/1.0/queryables",
-        target="https://waternode.ciroh.org/api/collections/viirs-1-day-composite/queryables",
-        media_type="application/schema+json",
-        title="Queryables for viirs-1-day"
+        collection.add_link(pystac.Link(
+            rel="related",
+            target='https://waternode.ciroh.org/data-guide.html',
+            title='VIIRS composite flood map entry in WPN data guide',
+            media_type='text/html'
         ))
 
-    # set stac version collection conforms to
-    collection.stac_version = "1.0.0"
-
-    # Enable the projection extension on the collection
-    ProjectionExtension.add_to(collection)
-
-    # Add EO extension to the collection
-    EOExtension.add_to(collection)
-
-    collection.providers = [
-        pystac.Provider(name="NOAA NESDIS", roles=["producer", "licensor"], url="https://www.nesdis.noaa.gov/"),
-        pystac.Provider(name="VIIRS Flood Team at George Mason University", roles=["producer"], url="https://fhrl.vse.gmu.edu/"),
-    ]
-
-    # Set the collection's parent, root and self_href 
-    collection.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{collection_object_key}')
-
-    # write updated collection to s3 and upsert into pgstac
-    update_collection(collection, collection_object_key, bucket_name,loader, s3)
-
-########### add items to that days sub-collection
-jpss_bucket_name = 'noaa-jpss'
-for single_date in generate_date_range(start_date, yesterday_date):
-
-    formatted_date = single_date.strftime("%Y/%m/%d")
-    jpss_prefix = f'JPSS_Blended_Products/VFM_1day_GLB/TIF/{formatted_date}/'
-
-    tif_urls = list_tifs_in_bucket(jpss_bucket_name, jpss_prefix, s3)
-    tmp_dir = tempfile.mkdtemp(dir='/home/dylan/wncat/tmpimgs')
-
-    for link in tif_urls:
-        # make netcdf link so can link to it in item as well
-        netCDF_link = link.replace("TIF", "NetCDF")
-        netCDF_link = netCDF_link[:-4] + ".nc"
-
-        filename = link.split("/")[-1]
-        base_filename = os.path.splitext(filename)[0]
+        # add a queryables link
+        collection.add_link(pystac.Link(
+            rel="http://www.opengis.net/def/rel/ogc/1.0/queryables",
+            target="https://waternode.ciroh.org/api/collections/viirs-1-day-composite/queryables",
+            media_type="application/schema+json",
+            title="Queryables for viirs-1-day"
+            ))
 
-        #extract date from filename
-        start_datetime, end_datetime = get_item_datetime(filename)
+        # set stac version collection conforms to
+        collection.stac_version = "1.0.0"
 
-        # get a datetime string for bucket object labels
-        item_datetime_string = start_datetime.strftime('%Y-%m-%d')
+        # Enable the projection extension on the collection
+        ProjectionExtension.add_to(collection)
 
-        img_path = os.path.join(tmp_dir, filename)
+        # Add EO extension to the collection
+        EOExtension.add_to(collection)
 
-        # Download the TIFF from the link
-        response = requests.get(link)
-        response.raise_for_status()  # Raises an HTTPError if the response was an unsuccessful status code
-
-        # Write the content of the response to a file in the temporary directory
-        with open(img_path, 'wb') as file:
-            file.write(response.content)
-
-        # get information about image
-        bbox, footprint, raster_crs = sm.get_bbox_and_footprint(img_path)
-
-        thumbnail_path = os.path.join(tmp_dir, f"thumbnail_{base_filename}.png")
-        sm.create_preview(img_path, thumbnail_path)
-
-        # Upload thumnail to s3
-        try:
-            sm.upload_to_s3_with_retry(s3, thumbnail_path, bucket_name, f'thumbnails/viirs-1-day/{item_datetime_string}/{base_filename}.png')
-            s3_thumbnail_url = f"https://{bucket_name}.s3.amazonaws.com/thumbnails/viirs-1-day/{item_datetime_string}/{base_filename}.png"
-        except NoCredentialsError:
-            print('Credentials not available.')
-        
-        # create overview. A cog of the original image is <1 mb which is fine
-        overview_path = os.path.join(tmp_dir, f"overview_{filename}")
-        output_profile = cog_profiles.get("deflate")
-        cog_translate(img_path, overview_path, output_profile)
-
-        # Upload overview to s3
-        try:
-            sm.upload_to_s3_with_retry(s3, overview_path, bucket_name, f"overviews/viirs-1-day/{item_datetime_string}/{filename}")
-            s3_overview_url = f"https://{bucket_name}.s3.amazonaws.com/overviews/viirs-1-day/{item_datetime_string}/{filename}"
-        except NoCredentialsError:
-            print('Credentials not available.') 
-
-        truncated_id = filename.split("_")[0]
-        title = f"{truncated_id}_{single_date.strftime('%Y%m%d')}"
-
-        item = pystac.Item(id=f"{item_datetime_string}-{truncated_id[-3:]}",
-                           geometry=footprint,
-                           bbox=bbox.bounds,
-                           collection = collection,
-                           datetime = start_datetime, 
-                           start_datetime = start_datetime,
-                           end_datetime = end_datetime,
-                           properties={
-                                "title": title, 
-                                "description" : 'VIIRS 1-day composite flood water fraction raster',
-                                "processing level": "4",
-                                "platform": "NPP, N20",
-                                "instrument": "VIIRS",
-                                "constellation": "JPSS",
-                                "gsd": 350,
-                                "license":'CC0-1.0',
-                               })
-
-        item.providers = [
+        collection.providers = [
             pystac.Provider(name="NOAA NESDIS", roles=["producer", "licensor"], url="https://www.nesdis.noaa.gov/"),
             pystac.Provider(name="VIIRS Flood Team at George Mason University", roles=["producer"], url="https://fhrl.vse.gmu.edu/"),
         ]
 
+        # the asset definitions every item shares, pgstac stores the items dehydrated against them
+        im.set_item_assets(collection, viirs_item_template)
+
+        # Set the collection's parent, root and self_href 
+        collection.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{collection_object_key}')
+
+        # write updated collection to s3 and upsert into pgstac, setting up the partitions for the whole backfill
+        update_collection(collection, collection_object_key, bucket_name,loader, s3,
+                          partition_trunc=partitionTrunc, partition_range=(start_date, yesterday_date))
+
+        # register the queryables the collection links to and index the ones searches filter on
+        with loader.db:
+            pm.provision_queryables(loader.db, collection.id, viirs_queryables)
+
+    ########### add items to that days sub-collection
+    jpss_bucket_name = 'noaa-jpss'
+
+    item_validator = im.ItemValidator(policy=validationPolicy, report_path=validationReportPath, sample_every=validationSampleEvery,
+                                      schema_dir=schema_dir, spool_dir='/home/dylan/wncat/validation-spool')
+
+    # load anything a crashed run left in the spool before adding to it
+    if bulkIngest:
+        with loader.db:
+            print(f"Loaded {pm.load_spool(loader, bulkIngestSpoolPath)} items left in the spool")
+
+    # the per item uploads run on this pool, items wait on their uploads before they're registered in pgstac
+    upload_executor = ThreadPoolExecutor(max_workers=uploadWorkers)
+    # uploads of spooled items not yet loaded, waited on before the spool is loaded
+    pending_uploads = []
+
+    # year/month partitions this run added items to, their geoparquet files are rewritten at the end
+    geoparquet_partitions = set()
+
+    # derived product collections are created the first time an item is published to them
+    derived_collections = {}
+
+    # zones the flood change areas are summarized by
+    change_zones = rm.load_zones(changeZonesPath, changeZonesIdField) if buildFloodChange and changeZonesPath else None
+
+    # zones the per item statistics are computed for
+    zonal_stats_zones = {zone_set_name: rm.load_zones(zones_path, id_field) for zone_set_name, (zones_path, id_field) in zonalStatsZones.items()}
+    for single_date in generate_date_range(start_date, yesterday_date):
+
+        formatted_date = single_date.strftime("%Y/%m/%d")
+        jpss_prefix = f'JPSS_Blended_Products/VFM_1day_GLB/TIF/{formatted_date}/'
+
+        tif_urls = list_tifs_in_bucket(jpss_bucket_name, jpss_prefix, s3)
+
+        # granules that already have an item in the database don't get their item rebuilt, they are still downloaded
+        # so the mosaic, tile index and derived products are built from the whole day
+        existing_links = set()
+        if skipExistingItems and tif_urls:
+            link_item_ids = {}
+            for link in tif_urls:
+                filename = link.split("/")[-1]
+                link_item_ids[link] = f"{get_item_datetime(filename)[0].strftime('%Y-%m-%d')}-{filename.split('_')[0][-3:]}"
+            with loader.db:
+                existing_ids = pm.existing_item_ids(loader.db, collection.id, link_item_ids.values())
+            existing_links = {link for link in tif_urls if link_item_ids[link] in existing_ids}
+            if existing_links:
+                print(f"{len(existing_links)} of {len(tif_urls)} items for {formatted_date} are already loaded, skipping them")
+
+        tmp_dir = tempfile.mkdtemp(dir='/home/dylan/wncat/tmpimgs')
+
+        # download all of the days granules first so they can be mosaicked before the items are built
+        img_paths = {}
+        for link in tif_urls:
+            filename = link.split("/")[-1]
+            img_path = os.path.join(tmp_dir, filename)
+
+            # Download the TIFF from the link
+            response = requests.get(link)
+            response.raise_for_status()  # Raises an HTTPError if the response was an unsuccessful status code
+
+            # Write the content of the response to a file in the temporary directory
+            with open(img_path, 'wb') as file:
+                file.write(response.content)
+
+            img_paths[link] = img_path
+
+        # merge the days granules into one COG so map clients only hit a single asset per tile
+        s3_mosaic_url = None
+        if buildDailyMosaic and img_paths:
+            mosaic_date_string = single_date.strftime('%Y-%m-%d')
+            mosaic_key = get_mosaic_key(single_date)
+            mosaic_path = os.path.join(tmp_dir, os.path.basename(mosaic_key))
+            rm.build_daily_mosaic(list(img_paths.values()), mosaic_path)
+
+            # Upload mosaic to s3
+            try:
+                sm.upload_to_s3_with_retry(s3, mosaic_path, bucket_name, mosaic_key, extra_args=pb.upload_args(pystac.MediaType.COG))
+                s3_mosaic_url = f"https://{bucket_name}.s3.amazonaws.com/{mosaic_key}"
+            except NoCredentialsError:
+                print('Credentials not available.')
+
+            # pre-render the mosaic to static tiles so web clients don't have to render on the fly
+            if exportTilePyramid:
+                tile_dir = os.path.join(tmp_dir, "tiles")
+                tiles = tm.export_tile_pyramid(mosaic_path, tile_dir, maxzoom=tilePyramidMaxZoom, fmt=tilePyramidFormat)
+                tm.upload_tile_pyramid(s3, tiles, bucket_name, f"tiles/viirs-1-day/{mosaic_date_string}", fmt=tilePyramidFormat)
+                print(f"Uploaded {len(tiles)} tiles for {mosaic_date_string}")
+
+        # (bbox, cog href) of each of the days items for the tile index
+        day_assets = []
+        # (id, json) of the days items for the NDJSON rollups
+        day_items = []
+        # time spent rendering and serializing items, kept apart from the raster work so item building throughput can be watched
+        item_build_seconds = 0.0
+
+        for link in tif_urls:
+            # make netcdf link so can link to it in item as well
+            netCDF_link = link.replace("TIF", "NetCDF")
+            netCDF_link = netCDF_link[:-4] + ".nc"
+
+            filename = link.split("/")[-1]
+            base_filename = os.path.splitext(filename)[0]
+
+            #extract date from filename
+            start_datetime, end_datetime = get_item_datetime(filename)
+
+            # get a datetime string for bucket object labels
+            item_datetime_string = start_datetime.strftime('%Y-%m-%d')
+
+            img_path = img_paths[link]
+
+            # get information about image
+            bbox, footprint, raster_crs = sm.get_bbox_and_footprint(img_path)
+
+            # an item that's already loaded keeps its item and overview, it only goes into the days tile index
+            if link in existing_links:
+                day_assets.append((bbox.bounds, f"https://{bucket_name}.s3.amazonaws.com/overviews/viirs-1-day/{item_datetime_string}/{filename}"))
+                continue
+
+            # the items uploads all start as soon as their file is ready and run while the rest of the item is built
+            item_uploads = []
+
+            thumbnail_ext = thumbnailFormat.lower()
+            thumbnail_path = os.path.join(tmp_dir, f"thumbnail_{base_filename}.{thumbnail_ext}")
+            sm.create_preview(img_path, thumbnail_path, fmt=thumbnailFormat)
+
+            # Upload thumnail to s3
+            item_uploads.append(upload_executor.submit(sm.upload_to_s3_with_retry, s3, thumbnail_path, bucket_name,
+                                                       f'thumbnails/viirs-1-day/{item_datetime_string}/{base_filename}.{thumbnail_ext}',
+                                                       extra_args=pb.upload_args(sm.preview_media_types[thumbnailFormat])))
+            s3_thumbnail_url = f"https://{bucket_name}.s3.amazonaws.com/thumbnails/viirs-1-day/{item_datetime_string}/{base_filename}.{thumbnail_ext}"
+        
+            # create overview. A cog of the original image is <1 mb which is fine
+            overview_path = os.path.join(tmp_dir, f"overview_{filename}")
+            output_profile = cog_profiles.get("deflate")
+            cog_translate(img_path, overview_path, output_profile)
+
+            # Upload overview to s3
+            item_uploads.append(upload_executor.submit(sm.upload_to_s3_with_retry, s3, overview_path, bucket_name,
+                                                       f"overviews/viirs-1-day/{item_datetime_string}/{filename}",
+                                                       extra_args=pb.upload_args(pystac.MediaType.COG)))
+            s3_overview_url = f"https://{bucket_name}.s3.amazonaws.com/overviews/viirs-1-day/{item_datetime_string}/{filename}"
 
-        # set stac version item conforms to
-        item.stac_version = "1.0.0"
-
-        # Enable the projection extension on the item
-        ProjectionExtension.add_to(item)
-
-        # Add EO extension to the item
-        EOExtension.add_to(item)
-
-        # Set snow and cloud cover percentages 
-        eo_ext = EOExtension.ext(item)
-        # calculate % cloud cover and then set
-        cloud_percent = sm.calculate_cover_percent(img_path,30)
-        eo_ext.cloud_cover = cloud_percent
-        # calculate % snow cover and then set
-        snow_percent= sm.calculate_cover_percent(img_path,20)
-        eo_ext.snow_cover = snow_percent
-
-        # Add projection information
-        proj_ext = ProjectionExtension.ext(item)
-        proj_ext.epsg = 4326
-
-        # Add thumbnail asset
-        item.add_asset(
-            key='thumbnail',
-            asset=pystac.Asset(
-                href=s3_thumbnail_url,
-                title="Thumbnail Image",
-                media_type='image/png'
-            )
-        )
-
-        # Add thumbnail asset
-        item.add_asset(
-            key='image',
-            asset=pystac.Asset(
-                href= s3_overview_url,
-                title="Cloud Optimized Geotiff",
-                media_type=pystac.MediaType.COG
-            )
-        )
-
-
-        # link out to tiff file on noaa jpss bucket
-        item.add_asset(
-            key='data',
-            asset=pystac.Asset(
-                href= netCDF_link,
-                title="netCDF",
-                media_type="application/netcdf"
-            )
-        )
-
-        # add item this days collection
-        collection.add_item(item)
-       
-        # Key for the item object in the S3 bucket
-        item_key = f'items/viirs-1-day/{item.datetime.strftime("%Y/%m/%d")}/{item.id}.json'
-        item.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{item_key}')
-         
-        # validate the item
-        try:
-            item.validate()
-            print("The item is valid according to the STAC specification.")
-        except Exception as e:
-            print(f"Validation error: {e}")
-
-        # Convert the item to a JSON string
-        item_json = json.dumps(item.to_dict())
-
-        # Write the JSON string to the S3 bucket
-        s3.put_object(Body=item_json, Bucket=bucket_name, Key=item_key, ContentType='application/json')
-
-        # insert/update the item in the database
-        loader.load_items(file=item.self_href, insert_mode=Methods.upsert)
-
-        # update collection
-        update_collection(collection, collection_object_key, bucket_name,loader, s3)
-
-    # clean up the tmp_dir
-    shutil.rmtree(tmp_dir)
+            truncated_id = filename.split("_")[0]
+            title = f"{truncated_id}_{single_date.strftime('%Y%m%d')}"
+
+            item_id = f"{item_datetime_string}-{truncated_id[-3:]}"
+
+            # Key for the item object in the S3 bucket
+            item_key = f'items/viirs-1-day/{start_datetime.strftime("%Y/%m/%d")}/{item_id}.json'
+            item_href = f'https://{bucket_name}.s3.amazonaws.com/{item_key}'
+
+            # one streaming pass over the image gets the value histogram everything below is derived from
+            band_stats = sm.calculate_band_stats(img_path)
+            histogram = band_stats["histogram"]
+
+            # calculate % cloud cover and % snow cover
+            cloud_percent = sm.cover_percent_from_histogram(histogram, rm.CLOUD)
+            snow_percent = sm.cover_percent_from_histogram(histogram, rm.SNOW)
+
+            # % of the valid pixels with any flood water so high flood days can be found with a property query
+            valid_pixels = histogram.sum() - (histogram[int(band_stats["nodata"])] if band_stats["nodata"] is not None else 0)
+            flooded_pixels = histogram[rm.WATER_FRACTION_MIN + 1:rm.WATER_FRACTION_MAX + 1].sum()
+            flooded_percent = float(np.round(flooded_pixels / valid_pixels * 100, 2)) if valid_pixels else 0.0
+
+            properties = {
+                "title": title,
+                "datetime": datetime_to_str(start_datetime),
+                "start_datetime": datetime_to_str(start_datetime),
+                "end_datetime": datetime_to_str(end_datetime),
+                "eo:cloud_cover": float(cloud_percent),
+                "eo:snow_cover": float(snow_percent),
+                "flooded_percent": flooded_percent,
+            }
+
+            # per zone flooded area and cloud/snow cover so searches can filter by region
+            for zone_set_name, zones in zonal_stats_zones.items():
+                properties[f"zonal_stats:{zone_set_name}"] = rm.zonal_stats(img_path, zones, zoneCacheDir, zoneCacheMaxBytes)
+
+            # full class/value histogram and statistics of the water fraction band
+            raster_band = {
+                "data_type": "uint8",
+                "statistics": band_stats["statistics"],
+                "histogram": {"count": 256, "min": -0.5, "max": 255.5, "buckets": histogram.tolist()},
+            }
+            if band_stats["nodata"] is not None:
+                raster_band["nodata"] = band_stats["nodata"]
+
+            assets = {
+                # the type matches the collection's item_assets for PNG thumbnails, so pgstac still dehydrates it
+                "thumbnail": {"href": s3_thumbnail_url, "type": sm.preview_media_types[thumbnailFormat]},
+                "image": {"href": s3_overview_url, "raster:bands": [raster_band]},
+                # link out to the netCDF file on noaa jpss bucket
+                "data": {"href": netCDF_link},
+            }
+            # Add the days global mosaic that this granule is part of
+            if s3_mosaic_url is not None:
+                assets["mosaic"] = {"href": s3_mosaic_url}
+
+            # build the item straight from the template, the pystac object model is skipped on this hot path
+            build_start = time.perf_counter()
+            item_dict = im.render_item(viirs_item_template, {
+                "id": item_id,
+                "geometry": footprint,
+                "bbox": list(bbox.bounds),
+                "properties": properties,
+                "assets": assets,
+                "links": im.item_links(item_href, collection.self_href, collection.title),
+            })
+
+            # add item to the collection
+            collection.add_link(pystac.Link(rel="item", target=item_href, media_type="application/json"))
+
+            # Convert the item to JSON bytes
+            item_json = im.dumps(item_dict)
+            item_build_seconds += time.perf_counter() - build_start
+
+            # validate the item as the validation policy says, failures go to the validation report
+            item_validator.check(item_dict, item_json)
+
+            # Write the JSON string to the S3 bucket
+            item_uploads.append(upload_executor.submit(pb.put_document, s3, bucket_name, item_key, item_json, encoding=jsonContentEncoding))
+
+            if bulkIngest:
+                # spool the item, it is loaded with the rest of the batch below once its uploads are done
+                # dehydrating only hits the database for the first item, the Loader caches the collection's base item
+                pm.spool_item(loader, item_dict, bulkIngestSpoolPath)
+                pending_uploads.extend(item_uploads)
+            else:
+                # the items assets and json have to be on s3 before it's searchable
+                sm.wait_for_uploads(item_uploads)
+
+                # insert/update the item in the database
+                with loader.db:
+                    loader.load_items(file=[item_dict], insert_mode=Methods.upsert)
+
+                # update collection
+                update_collection(collection, collection_object_key, bucket_name,loader, s3)
+
+            # stage the item for the geoparquet export, seeding its partition from the previous export the first time it's touched
+            if exportGeoparquet:
+                partition = em.item_partition(item_dict)
+                if partition not in geoparquet_partitions:
+                    em.seed_stage(s3, bucket_name, get_geoparquet_key(partition), geoparquetStageDir, partition)
+                    geoparquet_partitions.add(partition)
+                em.stage_item(geoparquetStageDir, partition, item_json)
+
+            day_assets.append((bbox.bounds, s3_overview_url))
+            day_items.append((item_id, item_json))
+
+        if day_items:
+            print(f"Built {len(day_items)} items for {single_date.strftime('%Y-%m-%d')} in {item_build_seconds:.3f}s "
+                  f"({len(day_items) / max(item_build_seconds, 1e-9):.0f} items/s)")
+
+        # merge the days items into the days rollup then add that to the months rollup
+        if buildNdjsonRollups and day_items:
+            day_rollup = em.update_day_rollup(s3, bucket_name, get_day_rollup_key(single_date), day_items)
+            n_days = em.update_month_rollup(s3, bucket_name, get_month_rollup_key(single_date), single_date.strftime('%Y-%m-%d'), day_rollup,
+                                            lambda day: get_day_rollup_key(datetime.strptime(day, '%Y-%m-%d')))
+            print(f"Rolled up {len(day_items)} items into {get_month_rollup_key(single_date)} ({n_days} days)")
+
+        # write the days quadkey -> COG index next to the items so a tiler can skip the spatial search
+        if buildTileIndex and day_assets:
+            mosaicjson = tm.build_mosaicjson(day_assets, quadkey_zoom=tileIndexZoom,
+                                             name=f"viirs-1-day-composite {single_date.strftime('%Y-%m-%d')}",
+                                             attribution="NOAA NESDIS, VIIRS Flood Team at George Mason University")
+            mosaicjson_key = f"items/viirs-1-day/{single_date.strftime('%Y/%m/%d')}/viirs-1-day-{single_date.strftime('%Y-%m-%d')}-mosaic.json"
+            pb.put_document(s3, bucket_name, mosaicjson_key, json.dumps(mosaicjson))
+
+        # update the rolling multi-day composites that end on this day
+        if buildTemporalComposites and s3_mosaic_url is not None:
+            # the block signatures of todays mosaic are computed while it is still on local disk. They are cached by the
+            # mosaic's ETag, so a reprocessed day gets new signatures and the composite windows it changed are recomputed
+            mosaic_etag = s3.head_object(Bucket=bucket_name, Key=mosaic_key)['ETag']
+            rm.load_or_compute_signatures(mosaic_path, os.path.join(compositeStateDir, 'signatures', f"{mosaic_date_string}.json"), mosaic_etag)
+
+            for period in compositePeriods:
+                product_name = f'viirs-{period}-day'
+                period_days = [single_date - timedelta(days=n) for n in reversed(range(period))]
+                if period_days[0] < start_date:
+                    continue
+
+                # days with no mosaic (no data published that day) are left out of the composite
+                composite_inputs = []
+                input_etags = {}
+                for day in period_days:
+                    try:
+                        etag = s3.head_object(Bucket=bucket_name, Key=get_mosaic_key(day))['ETag']
+                        composite_inputs.append((day.strftime('%Y-%m-%d'), f"https://{bucket_name}.s3.amazonaws.com/{get_mosaic_key(day)}"))
+                        input_etags[day.strftime('%Y-%m-%d')] = etag
+                    except ClientError:
+                        print(f"No mosaic for {day}, leaving it out of the {product_name} composite")
+
+                signatures = {day_string: rm.load_or_compute_signatures(href, os.path.join(compositeStateDir, 'signatures', f"{day_string}.json"), input_etags[day_string])
+                              for day_string, href in composite_inputs}
+
+                # the previous run's composite and manifest let unchanged windows be copied instead of recomputed
+                state_dir = os.path.join(compositeStateDir, product_name)
+                os.makedirs(state_dir, exist_ok=True)
+                previous_path = os.path.join(state_dir, 'composite.tif')
+                manifest_path = os.path.join(state_dir, 'manifest.json')
+                previous_manifest = None
+                if os.path.exists(previous_path) and os.path.exists(manifest_path):
+                    with open(manifest_path) as f:
+                        previous_manifest = json.load(f)
+
+                working_path = os.path.join(state_dir, 'composite_new.tif')
+                try:
+                    manifest, recomputed = rm.build_temporal_composite(composite_inputs, signatures, working_path,
+                                                                       previous_path=previous_path, previous_manifest=previous_manifest)
+                except ValueError as e:
+                    print(f"Skipping {product_name} composite for {mosaic_date_string}: {e}")
+                    continue
+                print(f"{product_name} composite for {mosaic_date_string}: recomputed {recomputed} of {len(manifest)} windows")
+
+                composite_filename = f"{product_name}-composite-{mosaic_date_string}.tif"
+                composite_path = os.path.join(tmp_dir, composite_filename)
+                cog_translate(working_path, composite_path, cog_profiles.get("deflate"), quiet=True)
+                os.replace(working_path, previous_path)
+                with open(manifest_path, 'w') as f:
+                    json.dump(manifest, f)
+
+                # Upload composite to s3
+                composite_key = f"composites/{product_name}/{mosaic_date_string}/{composite_filename}"
+                sm.upload_to_s3_with_retry(s3, composite_path, bucket_name, composite_key, extra_args=pb.upload_args(pystac.MediaType.COG))
+
+                if product_name not in derived_collections:
+                    derived_collections[product_name] = create_derived_collection(
+                        product_name,
+                        f'VIIRS {period}-day rolling composite of maximum and mean flood water fraction and clear observation count, derived from the viirs-1-day-composite collection.',
+                        datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc), bucket_name)
+                derived_collection, derived_collection_key = derived_collections[product_name]
+
+                composite_start = datetime.combine(period_days[0], datetime.min.time()).replace(tzinfo=timezone.utc)
+                composite_end = datetime.combine(single_date, datetime.max.time()).replace(microsecond=0, tzinfo=timezone.utc)
+                bbox, footprint, raster_crs = sm.get_bbox_and_footprint(composite_path)
+                composite_item = pystac.Item(id=f"{mosaic_date_string}-{period}day",
+                                             geometry=footprint,
+                                             bbox=bbox.bounds,
+                                             datetime=composite_end,
+                                             start_datetime=composite_start,
+                                             end_datetime=composite_end,
+                                             properties={
+                                                 "title": f"{product_name} composite ending {mosaic_date_string}",
+                                                 "description": f'VIIRS {period}-day max/mean flood water fraction and observation count',
+                                                 "composite_days": [day_string for day_string, _ in composite_inputs],
+                                             })
+                composite_item.stac_version = "1.0.0"
+                composite_item.add_asset(
+                    key='image',
+                    asset=pystac.Asset(
+                        href=f"https://{bucket_name}.s3.amazonaws.com/{composite_key}",
+                        title="Cloud Optimized Geotiff, bands are max water fraction, mean water fraction and observation count",
+                        media_type=pystac.MediaType.COG
+                    )
+                )
+                publish_derived_item(composite_item, product_name, derived_collection, derived_collection_key, bucket_name, loader, s3)
+
+        # fill todays cloud and snow gaps with the last clear observation, the state raster is kept with the composite state
+        if buildGapFilled and s3_mosaic_url is not None:
+            product_name = 'viirs-1-day-gapfilled'
+            gapfilled_filename = f"{product_name}-{mosaic_date_string}.tif"
+            gapfilled_working_path = os.path.join(tmp_dir, f"working_{gapfilled_filename}")
+            os.makedirs(compositeStateDir, exist_ok=True)
+            try:
+                rm.update_gap_filled(mosaic_path, os.path.join(compositeStateDir, f'{product_name}-state.tif'),
+                                     gapfilled_working_path, single_date, lookback=gapFillLookback)
+            except ValueError as e:
+                print(f"Skipping gap filled product for {mosaic_date_string}: {e}")
+            else:
+                gapfilled_path = os.path.join(tmp_dir, gapfilled_filename)
+                cog_translate(gapfilled_working_path, gapfilled_path, cog_profiles.get("deflate"), overview_resampling="nearest", quiet=True)
+                gapfilled_key = f"composites/{product_name}/{mosaic_date_string}/{gapfilled_filename}"
+                sm.upload_to_s3_with_retry(s3, gapfilled_path, bucket_name, gapfilled_key, extra_args=pb.upload_args(pystac.MediaType.COG))
+
+                if product_name not in derived_collections:
+                    derived_collections[product_name] = create_derived_collection(
+                        product_name,
+                        f'VIIRS 1-day composite flood water fraction with cloud and snow covered pixels filled by the most recent clear observation from up to {gapFillLookback} days earlier, derived from the viirs-1-day-composite collection.',
+                        datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc), bucket_name)
+                derived_collection, derived_collection_key = derived_collections[product_name]
+
+                gapfilled_datetime = datetime.combine(single_date, datetime.min.time()).replace(tzinfo=timezone.utc)
+                bbox, footprint, raster_crs = sm.get_bbox_and_footprint(gapfilled_path)
+                gapfilled_item = pystac.Item(id=f"{mosaic_date_string}-gapfilled",
+                                             geometry=footprint,
+                                             bbox=bbox.bounds,
+                                             datetime=gapfilled_datetime,
+                                             properties={
+                                                 "title": f"{product_name} {mosaic_date_string}",
+                                                 "description": 'VIIRS 1-day composite flood water fraction, cloud and snow gap filled',
+                                                 "gapfill_lookback_days": gapFillLookback,
+                                             })
+                gapfilled_item.stac_version = "1.0.0"
+                gapfilled_item.add_asset(
+                    key='image',
+                    asset=pystac.Asset(
+                        href=f"https://{bucket_name}.s3.amazonaws.com/{gapfilled_key}",
+                        title="Cloud Optimized Geotiff",
+                        media_type=pystac.MediaType.COG
+                    )
+                )
+                publish_derived_item(gapfilled_item, product_name, derived_collection, derived_collection_key, bucket_name, loader, s3)
+
+        # map where flooding appeared or receded since yesterday
+        if buildFloodChange and s3_mosaic_url is not None:
+            product_name = 'viirs-1-day-change'
+            previous_mosaic_key = get_mosaic_key(single_date - timedelta(days=1))
+            try:
+                s3.head_object(Bucket=bucket_name, Key=previous_mosaic_key)
+                previous_mosaic_exists = True
+            except ClientError:
+                previous_mosaic_exists = False
+                print(f"No mosaic for the day before {mosaic_date_string}, skipping the flood change product")
+
+            change_summary = None
+            if previous_mosaic_exists:
+                change_filename = f"{product_name}-{mosaic_date_string}"
+                change_working_path = os.path.join(tmp_dir, f"working_{change_filename}.tif")
+                try:
+                    change_summary = rm.detect_flood_change(f"https://{bucket_name}.s3.amazonaws.com/{previous_mosaic_key}",
+                                                            mosaic_path, change_working_path, zones=change_zones)
+                except ValueError as e:
+                    print(f"Skipping flood change product for {mosaic_date_string}: {e}")
+
+            if change_summary is not None:
+                change_path = os.path.join(tmp_dir, f"{change_filename}.tif")
+                cog_translate(change_working_path, change_path, cog_profiles.get("deflate"), overview_resampling="nearest", quiet=True)
+                change_key = f"composites/{product_name}/{mosaic_date_string}/{change_filename}.tif"
+                sm.upload_to_s3_with_retry(s3, change_path, bucket_name, change_key, extra_args=pb.upload_args(pystac.MediaType.COG))
+
+                change_summary_key = f"composites/{product_name}/{mosaic_date_string}/{change_filename}.geojson"
+                pb.put_document(s3, bucket_name, change_summary_key, json.dumps(change_summary), content_type='application/geo+json',
+                                encoding=jsonContentEncoding)
+
+                if product_name not in derived_collections:
+                    derived_collections[product_name] = create_derived_collection(
+                        product_name,
+                        'Newly flooded and receded areas between consecutive days of the VIIRS 1-day composite flood water fraction, derived from the viirs-1-day-composite collection.',
+                        datetime.combine(start_date, datetime.min.time()).replace(tzinfo=timezone.utc), bucket_name)
+                derived_collection, derived_collection_key = derived_collections[product_name]
+
+                change_datetime = datetime.combine(single_date, datetime.min.time()).replace(tzinfo=timezone.utc)
+                bbox, footprint, raster_crs = sm.get_bbox_and_footprint(change_path)
+                change_item = pystac.Item(id=f"{mosaic_date_string}-change",
+                                          geometry=footprint,
+                                          bbox=bbox.bounds,
+                                          datetime=change_datetime,
+                                          properties={
+                                              "title": f"{product_name} {mosaic_date_string}",
+                                              "description": 'VIIRS newly flooded and receded areas since the previous day',
+                                              "newly_flooded_km2": change_summary["summary"]["newly_flooded"]["area_km2"],
+                                              "receded_km2": change_summary["summary"]["receded"]["area_km2"],
+                                          })
+                change_item.stac_version = "1.0.0"
+                change_item.add_asset(
+                    key='image',
+                    asset=pystac.Asset(
+                        href=f"https://{bucket_name}.s3.amazonaws.com/{change_key}",
+                        title="Cloud Optimized Geotiff, 1 is newly flooded and 2 is receded",
+                        media_type=pystac.MediaType.COG
+                    )
+                )
+                change_item.add_asset(
+                    key='summary',
+                    asset=pystac.Asset(
+                        href=f"https://{bucket_name}.s3.amazonaws.com/{change_summary_key}",
+                        title="Change polygons and areas per zone",
+                        media_type=pystac.MediaType.GEOJSON
+                    )
+                )
+                publish_derived_item(change_item, product_name, derived_collection, derived_collection_key, bucket_name, loader, s3)
+
+        # load the spooled items once a batch has built up, the collection only needs updating once per batch
+        if bulkIngest and pm.spool_size(bulkIngestSpoolPath) >= bulkIngestBatchSize:
+            sm.wait_for_uploads(pending_uploads)
+            with loader.db:
+                pm.load_spool(loader, bulkIngestSpoolPath)
+            update_collection(collection, collection_object_key, bucket_name,loader, s3)
+
+        # clean up the tmp_dir, once nothing is still uploading from it
+        sm.wait_for_uploads(pending_uploads)
+        shutil.rmtree(tmp_dir)
+
+    # rewrite the geoparquet partitions items were added to
+    if exportGeoparquet and geoparquet_partitions:
+        with TemporaryDirectory() as export_dir:
+            for partition in sorted(geoparquet_partitions):
+                parquet_path, n_items = em.export_geoparquet_partition(geoparquetStageDir, partition, export_dir)
+                sm.upload_to_s3_with_retry(s3, parquet_path, bucket_name, get_geoparquet_key(partition),
+                                           extra_args=pb.upload_args("application/vnd.apache.parquet"))
+                print(f"Exported {n_items} items to {get_geoparquet_key(partition)}")
+
+    # load whatever is left in the spool
+    sm.wait_for_uploads(pending_uploads)
+    upload_executor.shutdown()
+    if bulkIngest:
+        with loader.db:
+            n_spooled = pm.load_spool(loader, bulkIngestSpoolPath)
+        if n_spooled > 0:
+            update_collection(collection, collection_object_key, bucket_name,loader, s3)
+
+    # wait on any deferred validation
+    validation_failures = item_validator.close()
+    if validation_failures:
+        print(f"{validation_failures} items failed validation, see {validationReportPath}")
     
 
@@ -63,39 +63,77 @@ def transform_bbox_to_crs(bbox, src_crs, dst_crs):
     minx, miny = transformer.transform(bbox.bounds[0], bbox.bounds[1])
     maxx, maxy = transformer.transform(bbox.bounds[2], bbox.bounds[3])
 
-def create_preview(raster, preview_path, size=(256, 256)):
+def apply_colormap(img_data, colormap):
+    """Map a single band of class values to an RGBA array using a GDAL colormap."""
+    # Build a lookup table so every pixel is colored in one indexing pass. Values not in the colormap stay transparent.
+    lut_size = max(max(colormap) + 1, int(img_data.max()) + 1) if img_data.size else max(colormap) + 1
+    lut = np.zeros((lut_size, 4), dtype=np.uint8)
+    for index, color in colormap.items():
+        lut[index] = color  # Color is expected to be RGBA
+    return lut[img_data]
+
+# media types of the formats classified images can be saved in
+preview_media_types = {"PNG": "image/png", "WEBP": "image/webp"}
+
+def save_classified_image(img_data, colormap, path, fmt="PNG"):
+    """
+    Save a band of class values colored with its GDAL colormap.
+
+    PNG is written in palette mode, the class values are the palette indices and the colormap is the palette
+    and its alphas, so a few colors cost one byte a pixel before compression. WEBP is written lossless. Both
+    reproduce the colormap exactly, values not in the colormap are transparent like in apply_colormap.
+    """
+    fmt = fmt.upper()
+    if fmt not in preview_media_types:
+        raise ValueError(f"Unsupported image format {fmt}, use one of {list(preview_media_types)}")
+
+    if fmt == "PNG" and img_data.dtype == np.uint8:
+        # the palette only needs to reach the highest value in the colormap
+        n_colors = min(max(max(colormap), int(img_data.max()) if img_data.size else 0) + 1, 256)
+        palette = np.zeros((n_colors, 4), dtype=np.uint8)
+        for index, color in colormap.items():
+            if index < n_colors:
+                palette[index] = color
+        image = Image.fromarray(img_data, 'P')
+        image.putpalette(palette[:, :3].tobytes())
+        # entries after the last translucent one are opaque by default and can be left out of the tRNS chunk
+        translucent = np.nonzero(palette[:, 3] < 255)[0]
+        transparency = palette[:translucent[-1] + 1, 3].tobytes() if translucent.size else None
+        if transparency is not None:
+            image.save(path, format="PNG", optimize=True, transparency=transparency)
+        else:
+            image.save(path, format="PNG", optimize=True)
+    else:
+        image = Image.fromarray(apply_colormap(img_data, colormap), 'RGBA')
+        if fmt == "WEBP":
+            image.save(path, format="WEBP", lossless=True, quality=100, method=6)
+        else:
+            image.save(path, format="PNG", optimize=True)
+
+def create_preview(raster, preview_path, size=(256, 256), fmt="PNG"):
     with rasterio.open(raster) as src:
         # Read the single band
         img_data = src.read(1)
         
         # Retrieve the colormap from the raster
         colormap = src.colormap(1)
-        
-        # Initialize an empty RGB(A) array
-        img_data_rgba = np.zeros((img_data.shape[0], img_data.shape[1], 4), dtype=np.uint8)
-        
-        # Apply the colormap to create an RGBA representation
-        for index, color in colormap.items():
-            mask = img_data == index
-            img_data_rgba[mask] = color  # Color is expected to be RGBA
-
-        # Convert the RGBA array to a PIL Image
-        pil_image = Image.fromarray(img_data_rgba, 'RGBA')
 
         # Calculate new size to maintain aspect ratio
-        img_width, img_height = pil_image.size
+        img_height, img_width = img_data.shape
         max_width, max_height = size
         scale = min(max_width/img_width, max_height/img_height)
 
         # New size with maintained aspect ratio
-        new_width = int(img_width * scale)
-        new_height = int(img_height * scale)
+        new_width = max(int(img_width * scale), 1)
+        new_height = max(int(img_height * scale), 1)
 
-        # Resize the image with new size
-        preview = pil_image.resize((new_width, new_height), Image.ANTIALIAS)
+        # Downsample the class values with nearest neighbour so every pixel keeps an exact colormap color
+        rows = ((np.arange(new_height) + 0.5) * img_height / new_height).astype(int)
+        cols = ((np.arange(new_width) + 0.5) * img_width / new_width).astype(int)
+        preview_data = img_data[rows[:, None], cols]
 
         # Save the preview
-        preview.save(preview_path, format="PNG")
+        save_classified_image(preview_data, colormap, preview_path, fmt)
 
 def delete_old_s3_files(bucket_name, prefix, start_date):
     """
@@ -131,11 +169,11 @@ def get_item_date(filename):
 
     return item_datetime
 
-def upload_to_s3_with_retry(s3_client, file_path, bucket, key, max_retries=5, backoff_factor=1.5):
+def upload_to_s3_with_retry(s3_client, file_path, bucket, key, max_retries=5, backoff_factor=1.5, extra_args=None):
     attempt = 0
     while attempt < max_retries:
         try:
-            s3_client.upload_file(file_path, bucket, key)
+            s3_client.upload_file(file_path, bucket, key, ExtraArgs=extra_args)
             return  # If upload succeeds, return from the function
         except NoCredentialsError:
             print('Credentials not available.')
@@ -146,6 +184,14 @@ def upload_to_s3_with_retry(s3_client, file_path, bucket, key, max_retries=5, ba
             attempt += 1
     raise Exception(f"Failed to upload {file_path} to s3://{bucket}/{key} after {max_retries} retries")
 
+def wait_for_uploads(futures):
+    """Wait for uploads submitted to an executor, raising the first upload error. The list is emptied."""
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        futures.clear()
+
 def calculate_cover_percent(img_path,val):
     try:
         with rasterio.open(img_path) as src:
@@ -165,3 +211,42 @@ def calculate_cover_percent(img_path,val):
     except Exception as e:
         print(f"An error occurred calculating cloud cover: {e}")
         return None
+
+def calculate_band_stats(img_path):
+    """
+    Stream a single band uint8 raster block by block and return its full value histogram.
+
+    The cover percentages and the STAC raster statistics are all derived from the histogram,
+    so the raster only has to be read once per item.
+
+    Returns:
+        dict: "histogram" (count of every value 0-255), "nodata" and summary "statistics" of the valid pixels.
+    """
+    with rasterio.open(img_path) as src:
+        if src.dtypes[0] != 'uint8':
+            raise ValueError(f"Band statistics need a uint8 raster, {img_path} is {src.dtypes[0]}")
+        nodata = src.nodata
+        histogram = np.zeros(256, dtype=np.int64)
+        for _, window in src.block_windows(1):
+            histogram += np.bincount(src.read(1, window=window).ravel(), minlength=256)
+
+    values = np.arange(256)
+    valid = histogram.copy()
+    if nodata is not None:
+        valid[int(nodata)] = 0
+    valid_count = valid.sum()
+    statistics = {"valid_percent": float(np.round(valid_count / histogram.sum() * 100, 2))}
+    if valid_count > 0:
+        mean = (values * valid).sum() / valid_count
+        statistics.update({
+            "minimum": int(values[valid > 0].min()),
+            "maximum": int(values[valid > 0].max()),
+            "mean": float(mean),
+            "stddev": float(np.sqrt((valid * (values - mean) ** 2).sum() / valid_count)),
+        })
+
+    return {"histogram": histogram, "nodata": nodata, "statistics": statistics}
+
+def cover_percent_from_histogram(histogram, val):
+    """Percentage of all pixels with value val (30 for cloudy pixels and 20 for snow), same as calculate_cover_percent."""
+    return np.round((histogram[val] / histogram.sum()) * 100)
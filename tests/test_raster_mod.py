@@ -0,0 +1,86 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import raster_mod as rm
+
+# a coarse global grid keeps the test rasters small
+RES = 1.0
+BLOCK = 64
+
+def write_raster(path, left, top, data, nodata=0):
+    """Write a single band uint8 EPSG:4326 raster with its top left corner at (left, top)."""
+    data = np.asarray(data, dtype=np.uint8)
+    with rasterio.open(path, 'w', driver='GTiff', width=data.shape[1], height=data.shape[0], count=1, dtype='uint8',
+                       crs='EPSG:4326', transform=from_origin(left, top, RES, RES), nodata=nodata) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+def test_daily_mosaic_grid_does_not_depend_on_granules(tmp_path):
+    west = write_raster(tmp_path / "west.tif", -20, 10, np.full((10, 10), 150))
+    east = write_raster(tmp_path / "east.tif", 30, 50, np.full((20, 10), 30))
+
+    rm.build_daily_mosaic([west, east], str(tmp_path / "both.tif"), block_size=BLOCK)
+    rm.build_daily_mosaic([west], str(tmp_path / "west_only.tif"), block_size=BLOCK)
+
+    with rasterio.open(tmp_path / "both.tif") as both, rasterio.open(tmp_path / "west_only.tif") as west_only:
+        assert both.shape == west_only.shape == (180, 360)
+        assert both.transform == west_only.transform == from_origin(-180, 90, RES, RES)
+        # the west granule lands in the same pixels in both mosaics
+        row, col = both.index(-15, 5)
+        assert both.read(1)[row, col] == west_only.read(1)[row, col] == 150
+        row, col = both.index(35, 40)
+        assert both.read(1)[row, col] == 30
+        assert west_only.read(1)[row, col] == 0
+
+def test_snow_after_flood_is_not_receded(tmp_path):
+    flooded = np.full((10, 10), 180)
+    today = np.full((10, 10), rm.SNOW)
+    # one column clears up with no water, that one has receded
+    today[:, 0] = rm.WATER_FRACTION_MIN
+    previous_path = write_raster(tmp_path / "previous.tif", -5, 5, flooded)
+    today_path = write_raster(tmp_path / "today.tif", -5, 5, today)
+
+    result = rm.detect_flood_change(previous_path, today_path, str(tmp_path / "change.tif"), block_size=BLOCK)
+
+    with rasterio.open(tmp_path / "change.tif") as src:
+        change = src.read(1)
+    assert (change[:, 0] == rm.RECEDED).all()
+    assert (change[:, 1:] == rm.NO_CHANGE).all()
+    # only the cleared column's area, ten 1 degree cells near the equator
+    assert 0 < result["summary"]["receded"]["area_km2"] < 10 * 112 * 112
+    assert result["summary"]["newly_flooded"]["area_km2"] == 0
+
+def test_signatures_are_recomputed_when_the_day_changes(tmp_path):
+    day_path = write_raster(tmp_path / "day.tif", -5, 5, np.full((10, 10), 120))
+    signature_path = str(tmp_path / "signatures" / "day.json")
+    first = rm.load_or_compute_signatures(day_path, signature_path, "etag-1", block_size=BLOCK)
+
+    # the day is reprocessed with more water
+    write_raster(tmp_path / "day.tif", -5, 5, np.full((10, 10), 190))
+    assert rm.load_or_compute_signatures(day_path, signature_path, "etag-1", block_size=BLOCK) == first
+    assert rm.load_or_compute_signatures(day_path, signature_path, "etag-2", block_size=BLOCK) != first
+
+def test_gap_fill_rerun_and_grid_change(tmp_path):
+    from datetime import date
+
+    state_path = str(tmp_path / "state.tif")
+    day1 = write_raster(tmp_path / "day1.tif", -5, 5, np.full((10, 10), 150))
+    day2 = write_raster(tmp_path / "day2.tif", -5, 5, np.full((10, 10), rm.CLOUD))
+    rm.update_gap_filled(day1, state_path, str(tmp_path / "out1.tif"), date(2024, 1, 1), block_size=BLOCK)
+    rm.update_gap_filled(day2, state_path, str(tmp_path / "out2.tif"), date(2024, 1, 2), block_size=BLOCK)
+    with rasterio.open(state_path) as state:
+        first_state = state.read()
+
+    # rerunning the same day gives the same product and state instead of aging the carried values twice
+    rm.update_gap_filled(day2, state_path, str(tmp_path / "out2_rerun.tif"), date(2024, 1, 2), block_size=BLOCK)
+    with rasterio.open(state_path) as state, rasterio.open(tmp_path / "out2_rerun.tif") as out:
+        assert (state.read() == first_state).all()
+        assert (state.read(2) == 1).all()
+        assert (out.read(1) == 150).all()
+
+    # a day on another grid starts the state over rather than failing every day from then on
+    day3 = write_raster(tmp_path / "day3.tif", -10, 10, np.full((20, 20), rm.CLOUD))
+    rm.update_gap_filled(day3, state_path, str(tmp_path / "out3.tif"), date(2024, 1, 3), block_size=BLOCK)
+    with rasterio.open(tmp_path / "out3.tif") as out:
+        assert (out.read(1) == rm.CLOUD).all()
@@ -0,0 +1,140 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import morecantile
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+import stac_mod as sm
+import publish_mod as pb
+
+#Functions to help web map clients tile the viirs products
+
+# all tiling is done on the web mercator grid that map clients request tiles in
+tms = morecantile.tms.get("WebMercatorQuad")
+
+def build_mosaicjson(assets, quadkey_zoom=6, minzoom=0, maxzoom=9, name=None, attribution=None):
+    """
+    Build a MosaicJSON document that maps web mercator quadkeys to the COGs that cover them.
+
+    A dynamic tiler can then look the assets for a tile up directly instead of running a
+    spatial search against the STAC API for every tile request.
+
+    Args:
+        assets (list): (bbox, href) pairs where bbox is (west, south, east, north) in EPSG:4326.
+        quadkey_zoom (int): Zoom level of the quadkeys used as index keys.
+        minzoom (int): Minimum zoom the mosaic should be served at.
+        maxzoom (int): Maximum zoom the mosaic should be served at.
+        name (str): Name written to the document.
+        attribution (str): Attribution written to the document.
+
+    Returns:
+        dict: The MosaicJSON (0.0.3) document.
+    """
+    tiles = {}
+    west, south, east, north = 180.0, 90.0, -180.0, -90.0
+    for bbox, href in assets:
+        # skip anything entirely outside of the web mercator latitude limits
+        if bbox[1] >= tms.bbox.top or bbox[3] <= tms.bbox.bottom:
+            continue
+        for tile in tms.tiles(*bbox, zooms=[quadkey_zoom]):
+            hrefs = tiles.setdefault(tms.quadkey(tile), [])
+            if href not in hrefs:
+                hrefs.append(href)
+        west, south = min(west, bbox[0]), min(south, bbox[1])
+        east, north = max(east, bbox[2]), max(north, bbox[3])
+
+    if not tiles:
+        west, south, east, north = tms.bbox
+
+    return {
+        "mosaicjson": "0.0.3",
+        "name": name,
+        "version": "1.0.0",
+        "attribution": attribution,
+        "minzoom": minzoom,
+        "maxzoom": maxzoom,
+        "quadkey_zoom": quadkey_zoom,
+        "bounds": [west, south, east, north],
+        "center": [(west + east) / 2, (south + north) / 2, minzoom],
+        "tiles": tiles,
+    }
+
+# media types of the tile formats the pyramid can be rendered in
+tile_media_types = {"PNG": "image/png", "WEBP": "image/webp"}
+
+# dataset and colormap opened once in each tile rendering process
+_tile_src = None
+_tile_colormap = None
+
+def _open_tile_source(cog_path):
+    """Open the COG once per worker process."""
+    global _tile_src, _tile_colormap
+    _tile_src = rasterio.open(cog_path)
+    _tile_colormap = _tile_src.colormap(1)
+
+def _render_tile(tile, out_dir, fmt, tile_size):
+    """Render one web mercator tile of the COG, returns the tile and its path or None if the tile is empty."""
+    z, x, y = tile
+    nodata = _tile_src.nodata if _tile_src.nodata is not None else 0
+    dst_transform = from_bounds(*tms.xy_bounds(morecantile.Tile(x, y, z)), tile_size, tile_size)
+    with WarpedVRT(_tile_src, crs="EPSG:3857", transform=dst_transform, width=tile_size, height=tile_size,
+                   resampling=Resampling.nearest, nodata=nodata) as vrt:
+        img_data = vrt.read(1)
+
+    # no point in writing or uploading tiles with no data in them
+    if np.all(img_data == nodata):
+        return tile, None
+
+    tile_path = os.path.join(out_dir, str(z), str(x), f"{y}.{fmt.lower()}")
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    sm.save_classified_image(img_data, _tile_colormap, tile_path, fmt)
+    return tile, tile_path
+
+def export_tile_pyramid(cog_path, out_dir, maxzoom=6, minzoom=0, fmt="PNG", tile_size=256, max_workers=None):
+    """
+    Render a COG to a static XYZ tile pyramid, colored with the COGs own colormap like create_preview.
+
+    Tiles are rendered in parallel across processes, each process keeps the COG open between tiles.
+
+    Args:
+        cog_path (str): Path of the COG to render.
+        out_dir (str): Directory the {z}/{x}/{y} tiles are written under.
+        maxzoom (int): Highest zoom level rendered.
+        minzoom (int): Lowest zoom level rendered.
+        fmt (str): "PNG" or "WEBP" (lossless).
+        tile_size (int): Width and height of the tiles in pixels.
+        max_workers (int): Number of rendering processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: ((z, x, y), tile path) of every non-empty tile written.
+    """
+    fmt = fmt.upper()
+    if fmt not in tile_media_types:
+        raise ValueError(f"Unsupported tile format {fmt}, use one of {list(tile_media_types)}")
+
+    with rasterio.open(cog_path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    tiles = [(t.z, t.x, t.y) for t in tms.tiles(*bounds, zooms=list(range(minzoom, maxzoom + 1)), truncate=True)]
+
+    # spawned rather than forked, the pipeline has database connections and upload threads open by now
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_open_tile_source, initargs=(cog_path,)) as executor:
+        rendered = executor.map(_render_tile, tiles, [out_dir] * len(tiles), [fmt] * len(tiles),
+                                [tile_size] * len(tiles), chunksize=64)
+        return [(tile, tile_path) for tile, tile_path in rendered if tile_path is not None]
+
+def upload_tile_pyramid(s3_client, tiles, bucket, prefix, fmt="PNG", max_workers=32):
+    """Upload rendered tiles to s3://bucket/prefix/{z}/{x}/{y}.{ext} concurrently on a thread pool."""
+    fmt = fmt.upper()
+    extra_args = pb.upload_args(tile_media_types[fmt])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(sm.upload_to_s3_with_retry, s3_client, tile_path, bucket,
+                                   f"{prefix}/{z}/{x}/{y}.{fmt.lower()}", extra_args=extra_args)
+                   for (z, x, y), tile_path in tiles]
+        for future in futures:
+            future.result()
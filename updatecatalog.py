@@ -4,6 +4,7 @@ import os
 import json
 import rasterio
 import urllib.request
+from urllib.parse import urljoin
 import pystac
 from datetime import datetime, timezone
 from shapely.geometry import Polygon, mapping, box
@@ -20,6 +21,8 @@ from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 
 import stac_mod as sm
+import catalog_mod as cm
+import publish_mod as pb
 
 # Create an S3 client 
 s3 = boto3.client('s3')
@@ -28,33 +31,63 @@ s3 = boto3.client('s3')
 bucket_name = 'fim-public'
 catalog_object_key = 'catalog.json'
 collection_object_key = 'collections/viirs-1-day.json'
+subcatalog_prefix = 'catalogs/viirs-1-day'
+
+# Where the manifest of each publish is kept, and how many publishes back superseded documents are kept for readers
+version_prefix = 'versions/viirs-1-day'
+keepVersions = 7
 
 catalog_data = s3.get_object(Bucket=bucket_name, Key=catalog_object_key)
-catalog_content = catalog_data['Body'].read().decode('utf-8')
+catalog_content = pb.read_body(catalog_data).decode('utf-8')
 catalog = pystac.Catalog.from_dict(json.loads(catalog_content))
 
 collection_data = s3.get_object(Bucket=bucket_name, Key=collection_object_key)
-collection_content = collection_data['Body'].read().decode('utf-8')
+collection_content = pb.read_body(collection_data).decode('utf-8')
 collection = pystac.Collection.from_dict(json.loads(collection_content))
 
+# A collection published before the sub-catalogs links its items directly. Move those links into year/month
+# sub-catalogs and publish that on its own first, so the update below finds the existing items in them
+collection_url = f'https://{bucket_name}.s3.amazonaws.com/{collection_object_key}'
+legacy_item_links = collection.get_links('item')
+if legacy_item_links:
+    print(f"Migrating {len(legacy_item_links)} item links from the collection into sub-catalogs")
+    legacy_items = []
+    for link in legacy_item_links:
+        item_url = urljoin(collection_url, link.get_href(transform_href=False))
+        item_dict = cm.get_json(s3, bucket_name, pb.s3_key(bucket_name, item_url))
+        if item_dict is None:
+            print(f"Item {item_url} linked from the collection doesn't exist, dropping its link")
+            continue
+        properties = item_dict["properties"]
+        legacy_items.append((item_url, pystac.utils.str_to_datetime(properties.get("datetime") or properties["start_datetime"])))
+    migration = pb.Publication(bucket_name, version_prefix)
+    cm.add_items_to_subcatalogs(s3, bucket_name, subcatalog_prefix, collection, collection_url,
+                                f'https://{bucket_name}.s3.amazonaws.com/{catalog_object_key}', legacy_items, publication=migration)
+    collection.remove_links('item')
+    manifest = migration.commit(s3, collection_object_key, collection.to_dict())
+    print(f"Migrated {len(legacy_items)} items into {len(manifest['written'])} sub-catalogs")
+
 #### delete catalog self_href and parent child relationships. Doing this because item addition gets confused otherwise.
 
 catalog.remove_links('self')
 catalog.remove_links('parent')
 catalog.remove_links('child')
 
-# Remove the self_href, parent, and child relationships for collection
+# Remove the self_href and parent relationships for collection. Its children are the year sub-catalogs, those stay
 collection.remove_links('self')
 collection.remove_links('parent')
-collection.remove_links('child')
 
 ########### download images and add them to collection
 base_url = "https://floodlight.ssec.wisc.edu/composite/"
 
 soup = sm.fetch_page_content(base_url)
 urls = sm.extract_image_urls(base_url, soup, ["composite1", ".tif"])
-# Extract all item IDs from the collection
-item_ids = {item.id for item in collection.get_all_items()}
+# Extract the item IDs linked from the month sub-catalogs the candidate urls fall in, the rest of the catalog isn't read
+url_months = {re.search(r"(\d{8})", url.split('/')[-1]).group(1)[:6] for url in urls}
+item_ids = set()
+for url_month in url_months:
+    _, (_, month_catalog) = cm.find_subcatalogs(s3, bucket_name, collection, datetime.datetime(int(url_month[:4]), int(url_month[4:]), 1))
+    item_ids |= cm.linked_item_ids(month_catalog)
 
 # Extract date strings from item IDs
 item_dates = {re.search(r"(\d{8})", item_id).group(1) for item_id in item_ids if re.search(r"(\d{8})", item_id)}
@@ -110,11 +143,11 @@ with TemporaryDirectory(dir='/home/dylan/wncat/tmpimgs') as tmp_dir:
 
                 # Upload the COG to S3 in the 'assets' folder
                 s3_cog_key = f'assets/cog_{filename}'
-                sm.upload_to_s3_with_retry(s3, cog_path, bucket_name, s3_cog_key)
+                sm.upload_to_s3_with_retry(s3, cog_path, bucket_name, s3_cog_key, extra_args=pb.upload_args(pystac.MediaType.GEOTIFF))
 
                 # Upload thumnail to s3
                 try:
-                    sm.upload_to_s3_with_retry(s3, thumbnail_path, bucket_name, f'thumbnails/{filename}.png')
+                    sm.upload_to_s3_with_retry(s3, thumbnail_path, bucket_name, f'thumbnails/{filename}.png', extra_args=pb.upload_args('image/png'))
                     s3_thumbnail_url = f"https://{bucket_name}.s3.amazonaws.com/thumbnails/{filename}.png"
                 except NoCredentialsError:
                     print('Credentials not available.')
@@ -159,6 +192,10 @@ for filename, (bbox, footprint, thumbnail_url,cog_url) in bbox_and_footprints.it
     # Append the new item to the list
     stac_items.append(item)
 
+# everything this update writes goes into one publication, readers only see it once the collection is switched over at the end
+publication = pb.Publication(bucket_name, version_prefix)
+item_urls = []
+
 for item in stac_items:
     
     # Key for the object in the S3 bucket, inside the "items" folder
@@ -169,11 +206,17 @@ for item in stac_items:
 
     # Set the item's self_href to the S3 URL
     item.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{object_key}')   
-    # Convert the item to a JSON string
-    item_json = json.dumps(item.to_dict())
 
-    # Write the JSON string to the S3 bucket
-    s3.put_object(Body=item_json, Bucket=bucket_name, Key=object_key, ContentType='application/json')
+    # stage the item under a content addressed version of its key, it's uploaded with the rest of the publication
+    item_urls.append((publication.add(item.to_dict(), object_key), item.datetime))
+
+# link the new items from their month sub-catalogs, only those and the year catalogs above them are rewritten
+cm.add_items_to_subcatalogs(s3, bucket_name, subcatalog_prefix, collection, collection_url,
+                            f'https://{bucket_name}.s3.amazonaws.com/{catalog_object_key}',
+                            item_urls, publication=publication)
+
+# the items are linked from the sub-catalogs, so the collection document doesn't grow with every update
+collection.remove_links('item')
 
 # Restore the self_href, parent, and child relationships
 catalog.set_self_href(f'https://{bucket_name}.s3.amazonaws.com/{catalog_object_key}')
@@ -196,11 +239,11 @@ catalog.add_link(catalog_child)
 catalog_json = json.dumps(catalog.to_dict())
 
 # Write the catalog JSON string to the S3 bucket
-s3.put_object(Body=catalog_json, Bucket=bucket_name, Key=catalog_object_key, ContentType='application/json')
-
-# Convert the collection to a JSON string
-collection_json = json.dumps(collection.to_dict())
+pb.put_document(s3, bucket_name, catalog_object_key, catalog_json, cache="root")
 
-# Write the collection JSON string to the S3 bucket
-s3.put_object(Body=collection_json, Bucket=bucket_name, Key=collection_object_key, ContentType='application/json')
+# upload the staged items and sub-catalogs in parallel, then switch readers over by writing the collection last
+manifest = publication.commit(s3, collection_object_key, collection.to_dict())
+print(f"Published {len(manifest['written'])} objects, superseding {len(manifest['replaced'])}")
 
+# delete what older publishes superseded
+print(f"Deleted {pb.collect_garbage(s3, bucket_name, version_prefix, keep=keepVersions)} superseded objects")